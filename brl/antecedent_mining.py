@@ -5,234 +5,622 @@ pd.options.mode.chained_assignment = None  # default='warn'
 import operator
 from .utils import *
 from collections import defaultdict
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import os
+import hashlib
+import tempfile
 
-def generate_antecedent_list(data_matrix, num_samples, min_support_threshold, max_antecedent_length):
+# Largest dense coverage index (in bytes) built when coverage_mode is "auto", beyond it the lazy index is used
+MAX_COVERAGE_BYTES = 256 * 1024 * 1024
 
-    counts = defaultdict(int)
-    attribute_indices =  {} # Keeps track of the index of an attribute in the data
+# Itemsets whose row bitsets count_itemsets intersects at once, which bounds its memory
+ITEMSET_COUNT_BATCH_SIZE = 1024
+
+def generate_antecedent_list(data_matrix, num_samples, min_support_threshold, max_antecedent_length, coverage_mode="auto", max_coverage_bytes=MAX_COVERAGE_BYTES, n_jobs=1, method="fpgrowth", itemset_mode="all", min_antecedent_length=1, item_dictionary=None, cache_dir=None):
+    '''
+    Mine frequent itemsets and return them as an AntecedentGroup, whose expressions compare item codes.
+    Data passed to the model afterwards must be encoded with all_antecedents.item_dictionary.
+
+    data_matrix - raw feature rows, or rows already encoded with item_dictionary
+    item_dictionary - ItemDictionary data_matrix is encoded with, if None one is built from data_matrix
+
+    method - "fpgrowth" mines an FP-Tree, "eclat" intersects per-item row bitsets depth first, which suits
+        dense categorical data and yields the coverage index as a by-product. Both return the same antecedents in the same order.
+
+    coverage_mode - "dense" precomputes a packed bitset per antecedent over the rows of data_matrix,
+        "lazy" builds them on demand behind an LRU bounded by max_coverage_bytes, "auto" picks dense
+        unless it would exceed max_coverage_bytes, None skips the coverage index
+    n_jobs - number of worker processes mining the top-level conditional trees, -1 uses every core (fpgrowth only)
+    itemset_mode - "all" keeps every frequent itemset, "closed" drops itemsets with a superset of equal support,
+        "maximal" drops itemsets with any frequent superset (supersets longer than max_antecedent_length are not considered)
+    min_antecedent_length - shortest antecedent to keep, applied after the closed/maximal filtering
+    cache_dir - directory of mined antecedent sets keyed by a hash of the encoded data and mining parameters,
+        a hit skips mining (and building a dense coverage index if one was cached)
+    '''
+
+    if item_dictionary is None:
+        item_dictionary = ItemDictionary()
+        data_matrix = item_dictionary.encode(data_matrix, extend=True)
+    data_matrix = np.asarray(data_matrix, dtype=np.int32)
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, antecedent_cache_key(data_matrix, item_dictionary, num_samples, min_support_threshold, max_antecedent_length, itemset_mode, min_antecedent_length) + ".npz")
+        if os.path.exists(cache_path):
+            return load_antecedent_cache(cache_path, data_matrix, item_dictionary, coverage_mode, max_coverage_bytes)
 
     # Construct the counts list
-    for person_features in data_matrix:
-        for i, attribute in enumerate(person_features):
-            counts[attribute] += 1
+    counts = count_items(data_matrix, len(item_dictionary))
 
-            if attribute not in attribute_indices:
-                attribute_indices[attribute] = i
+    # print("Feature Counts:", list(enumerate(counts)))
 
-    # print("Feature Counts:", list(counts.items()))
+    sorted_items, item_ranks = rank_items(counts, num_samples, min_support_threshold)
 
-    # Prune the counts list, remove every element that has support lower than the threshold
-    pruned_counts = {k: v for k,v in counts.items() if v/num_samples > min_support_threshold}
+    # Run FP-Growth or Eclat to find the frequent itemsets
+    output_rank_itemsets = []
+    output_supports = []
+    output_bitsets = None
+
+    if method == "fpgrowth":
+
+        # Create the FP-Tree
+        fp_tree = FP_Tree(len(sorted_items))
+        insert_transactions(fp_tree, data_matrix, item_ranks)
+        mine_fp_tree(fp_tree, output_rank_itemsets, output_supports, num_samples, min_support_threshold, max_antecedent_length, n_jobs)
+
+    elif method == "eclat":
+        item_bitsets = create_item_bitsets(data_matrix, sorted_items, item_dictionary)
+        output_bitsets = []
+        find_itemsets_vertical(item_bitsets, list(range(len(sorted_items))), [], full_bitset(len(data_matrix)), output_rank_itemsets, output_supports, output_bitsets, num_samples, min_support_threshold, max_antecedent_length)
+
+    else:
+        raise ValueError("Unknown mining method: {}".format(method))
+
+    # Keep only the itemsets requested by itemset_mode and min_antecedent_length
+    kept_indices = filter_itemsets(output_rank_itemsets, output_supports, itemset_mode, min_antecedent_length)
+    output_rank_itemsets = [output_rank_itemsets[i] for i in kept_indices]
+    if output_bitsets is not None:
+        output_bitsets = [output_bitsets[i] for i in kept_indices]
+
+    # print("Number of Samples:", num_samples, "Minimum Support Threshold:", min_support_threshold, "Max Antecedent Length:", max_antecedent_length, "Antecedents Mined:", len(output_rank_itemsets))
+
+    all_antecedents = create_antecedent_group(output_rank_itemsets, sorted_items, item_dictionary)
+    all_antecedents.coverage = build_coverage_index(all_antecedents.antecedents, data_matrix, coverage_mode, max_coverage_bytes, output_bitsets)
+
+    if cache_path is not None:
+        save_antecedent_cache(cache_path, output_rank_itemsets, sorted_items, all_antecedents.coverage)
+
+    return all_antecedents
+
+# Hex digest identifying an encoded data matrix and the parameters that change the mined antecedents.
+# The mining method and n_jobs are left out since every backend mines the same antecedents.
+# Item codes follow the order values first appear in, and the items are hashed by their type and text rather
+# than pickled, so the same data and parameters give the same key in every process and library version.
+def antecedent_cache_key(data_matrix, item_dictionary, num_samples, min_support_threshold, max_antecedent_length, itemset_mode, min_antecedent_length):
+    digest = hashlib.sha256()
+    digest.update(str(data_matrix.shape).encode())
+    digest.update(np.ascontiguousarray(data_matrix, dtype=np.int32).tobytes())
+    for column, value in item_dictionary.items:
+        digest.update(repr((column, type(value).__name__, str(value))).encode())
+    digest.update(repr((num_samples, min_support_threshold, max_antecedent_length, itemset_mode, min_antecedent_length)).encode())
+    return digest.hexdigest()
+
+# Cache files are uncompressed npz archives of int arrays: the ranked items, the rank itemsets flattened with their
+# offsets, and the dense coverage bitsets (empty if none were built)
+def save_antecedent_cache(cache_path, rank_itemsets, sorted_items, coverage):
+    itemset_lengths = [len(itemset) for itemset in rank_itemsets]
+    offsets = np.zeros(len(rank_itemsets) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(itemset_lengths)
+    flat_itemsets = np.array([rank for itemset in rank_itemsets for rank in itemset], dtype=np.int32)
+
+    bitsets = np.zeros((0, 0), dtype=np.uint8)
+    if coverage is not None and not isinstance(coverage, LazyCoverageIndex):
+        bitsets = coverage.bitsets
+
+    # Write to a temporary file first so readers never see a partial cache entry
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+    with os.fdopen(file_descriptor, "wb") as temp_file:
+        np.savez(temp_file, sorted_items=np.array(sorted_items, dtype=np.int32), itemsets=flat_itemsets, offsets=offsets, bitsets=bitsets)
+    os.replace(temp_path, cache_path)
+
+def load_antecedent_cache(cache_path, data_matrix, item_dictionary, coverage_mode, max_coverage_bytes=MAX_COVERAGE_BYTES):
+    with np.load(cache_path, allow_pickle=False) as cached:
+        sorted_items = cached["sorted_items"].tolist()
+        flat_itemsets = cached["itemsets"].tolist()
+        offsets = cached["offsets"].tolist()
+        bitsets = cached["bitsets"]
+
+    rank_itemsets = [flat_itemsets[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+    all_antecedents = create_antecedent_group(rank_itemsets, sorted_items, item_dictionary)
+    all_antecedents.coverage = build_coverage_index(all_antecedents.antecedents, data_matrix, coverage_mode, max_coverage_bytes, bitsets if len(bitsets) == len(rank_itemsets) and bitsets.size > 0 else None)
+
+    return all_antecedents
 
-    # Sort the pruned counts and iterate through each element in this order
-    sorted_attributes = sorted(pruned_counts, key=pruned_counts.get, reverse=True)
+def generate_antecedent_list_from_chunks(make_chunks, min_support_threshold, max_antecedent_length, n_jobs=1, itemset_mode="all", min_antecedent_length=1):
+    '''
+    Streaming counterpart of generate_antecedent_list for tables that do not fit in memory. Makes two passes
+    over the data, the first counts item supports and the second builds the FP-Tree from the frequent
+    items only, so peak memory is one chunk plus the tree. No coverage index is built.
 
-    # Create the FP-Tree
-    fp_tree = FP_Tree()
+    make_chunks - callable returning a fresh iterable of row chunks (DataFrames or 2-D arrays) on each call,
+        e.g. lambda: pd.read_csv(path, usecols=feature_columns, chunksize=10000)
+    '''
 
-    # For each example, sort according to the order of the sorted_attributes list and add to fp_tree
-    for sample in data_matrix:
-        
-        # Prune for minimum support before adding to tree
-        sample = list(filter(lambda x: x in sorted_attributes, sample))    
-        sample = sorted(sample, key=lambda x: sorted_attributes.index(x))
-        fp_tree.insert_list(sample, fp_tree.root)
+    item_dictionary = ItemDictionary()
+    counts = np.zeros(0, dtype=np.int64)
+    num_samples = 0
 
-    # Run FP-Growth algorithm to find the frequent itemsets
-    output_itemsets = []
+    # First pass, build the item dictionary and count item supports
+    for chunk in make_chunks():
+        encoded_chunk = item_dictionary.encode(chunk_rows(chunk), extend=True)
+        chunk_counts = count_items(encoded_chunk, len(item_dictionary))
+        chunk_counts[:len(counts)] += counts
+        counts = chunk_counts
+        num_samples += len(encoded_chunk)
 
-    find_itemsets(fp_tree, [], output_itemsets, num_samples, min_support_threshold, max_antecedent_length, attribute_indices)
+    sorted_items, item_ranks = rank_items(counts, num_samples, min_support_threshold)
 
-    # print("Number of Samples:", num_samples, "Minimum Support Threshold:", min_support_threshold, "Max Antecedent Length:", max_antecedent_length, "Antecedents Mined:", len(output_itemsets))
+    # Second pass, build the FP-Tree
+    fp_tree = FP_Tree(len(sorted_items))
+    for chunk in make_chunks():
+        insert_transactions(fp_tree, item_dictionary.encode(chunk_rows(chunk)), item_ranks)
 
-    def create_expressions(raw_ant_list):
-        expression = [Expression(attribute_indices[ant], operator.eq, ant) for ant in raw_ant_list]
+    output_rank_itemsets = []
+    output_supports = []
+    mine_fp_tree(fp_tree, output_rank_itemsets, output_supports, num_samples, min_support_threshold, max_antecedent_length, n_jobs)
+
+    kept_indices = filter_itemsets(output_rank_itemsets, output_supports, itemset_mode, min_antecedent_length)
+    output_rank_itemsets = [output_rank_itemsets[i] for i in kept_indices]
+
+    return create_antecedent_group(output_rank_itemsets, sorted_items, item_dictionary)
+
+def chunk_rows(chunk):
+    if isinstance(chunk, pd.DataFrame):
+        return chunk.values
+    return chunk
+
+# Number of rows containing each item code of an encoded data matrix
+def count_items(data_matrix, num_items):
+    return np.bincount(data_matrix[data_matrix != MISSING_ITEM], minlength=num_items)
+
+# Item codes above the support threshold sorted by decreasing count, and the rank of every code (-1 if pruned)
+def rank_items(counts, num_samples, min_support_threshold):
+
+    # Prune the counts list, remove every element that has support lower than the threshold
+    pruned_items = [code for code, count in enumerate(counts) if count/num_samples > min_support_threshold]
+
+    # Sort the pruned counts and give each item its integer rank in this order
+    sorted_items = sorted(pruned_items, key=lambda code: -counts[code])
+    item_ranks = np.full(len(counts) + 1, -1, dtype=np.int32) # Extra slot so MISSING_ITEM maps to -1
+    item_ranks[sorted_items] = np.arange(len(sorted_items), dtype=np.int32)
+
+    return sorted_items, item_ranks
+
+# For each example, map to ranks, prune for minimum support and sort before adding to fp_tree
+def insert_transactions(fp_tree, data_matrix, item_ranks):
+    ranked_rows = np.sort(item_ranks[data_matrix], axis=1)
+    for ranks in ranked_rows.tolist():
+        fp_tree.insert(ranks[ranks.count(-1):]) # Pruned items sort to the front
+
+def mine_fp_tree(fp_tree, output_list, output_supports, total_transactions, min_support, max_antecedent_length, n_jobs=1):
+    if n_jobs == 1:
+        find_itemsets(fp_tree, [], output_list, output_supports, total_transactions, min_support, max_antecedent_length)
+    else:
+        find_itemsets_parallel(fp_tree, output_list, output_supports, total_transactions, min_support, max_antecedent_length, n_jobs)
+
+def create_antecedent_group(rank_itemsets, sorted_items, item_dictionary):
+
+    def create_expressions(rank_itemset):
+        codes = [sorted_items[rank] for rank in rank_itemset]
+        expression = [Expression(item_dictionary.column(code), operator.eq, code, item_dictionary) for code in codes]
         return expression
 
-    expressions_list = [create_expressions(raw_ant_list) for raw_ant_list in output_itemsets]
+    expressions_list = [create_expressions(rank_itemset) for rank_itemset in rank_itemsets]
     antecedent_list = [Antecedent(expression) for expression in expressions_list]
-    all_antecedents = AntecedentGroup(antecedent_list)
+    return AntecedentGroup(antecedent_list, item_dictionary=item_dictionary)
 
-    return all_antecedents
+def prune_antecedents(all_antecedents, data_matrix, outcomes, min_confidence=None, min_lift=None, remove_duplicates=True):
+    '''
+    Label-aware pruning of mined antecedents before MCMC, returns a new AntecedentGroup
+
+    data_matrix, outcomes - encoded training rows and their labels
+    min_confidence - drop antecedents whose most confident label, P(label | antecedent applies), is below this
+    min_lift - drop antecedents whose largest lift, P(label | antecedent applies) / P(label), is below this
+    remove_duplicates - of antecedents covering exactly the same rows keep only the one of lowest cardinality
+    '''
+    outcomes = np.asarray(outcomes)
+    coverage = all_antecedents.coverage
+    if coverage is None or not coverage.built_over(data_matrix, all_antecedents.item_dictionary):
+        coverage = CoverageIndex.from_antecedents(all_antecedents.antecedents, encode_rows(data_matrix, all_antecedents.item_dictionary))
+
+    labels = list(range(int(outcomes.max()) + 1))
+    label_bitsets = [pack_rows(outcomes == label) for label in labels]
+    base_rates = [np.count_nonzero(outcomes == label) / len(outcomes) for label in labels]
+
+    kept_ids = []
+    low_signal = 0
+    for ant in all_antecedents.antecedents:
+        bitset = coverage.get_bitset(ant.id)
+        support = popcount(bitset)
+        if support == 0:
+            low_signal += 1
+            continue
+
+        confidences = [popcount(bitset & label_bitset) / support for label_bitset in label_bitsets]
+        if min_confidence is not None and max(confidences) < min_confidence:
+            low_signal += 1
+            continue
+        if min_lift is not None and max(c / r for c, r in zip(confidences, base_rates) if r > 0) < min_lift:
+            low_signal += 1
+            continue
+        kept_ids.append(ant.id)
+
+    duplicates = 0
+    if remove_duplicates:
+        seen_coverage = set()
+        unique_ids = []
+        for i in sorted(kept_ids, key=lambda i: (all_antecedents.antecedents[i].length(), i)):
+            key = coverage.get_bitset(i).tobytes()
+            if key in seen_coverage:
+                duplicates += 1
+                continue
+            seen_coverage.add(key)
+            unique_ids.append(i)
+        kept_ids = sorted(unique_ids)
+
+    print("Antecedents Pruned: R {} -> {} ({} low confidence/lift, {} duplicate coverage)".format(all_antecedents.length(), len(kept_ids), low_signal, duplicates))
+
+    return all_antecedents.subset(kept_ids)
+
+# bitsets - rows covered by each antecedent if the miner already computed them
+def build_coverage_index(antecedents, data_matrix, coverage_mode, max_coverage_bytes=MAX_COVERAGE_BYTES, bitsets=None):
+    if coverage_mode is None:
+        return None
+
+    bytes_per_antecedent = (len(data_matrix) + 7) // 8
+    if coverage_mode == "auto":
+        coverage_mode = "dense" if len(antecedents) * bytes_per_antecedent <= max_coverage_bytes else "lazy"
+
+    if coverage_mode == "dense":
+        if bitsets is not None:
+            return CoverageIndex(np.array(bitsets, dtype=np.uint8).reshape(len(antecedents), bytes_per_antecedent), len(data_matrix), data_key(data_matrix))
+        return CoverageIndex.from_antecedents(antecedents, data_matrix)
+    elif coverage_mode == "lazy":
+        return LazyCoverageIndex(antecedents, data_matrix, max(1, max_coverage_bytes // max(1, bytes_per_antecedent)))
+    else:
+        raise ValueError("Unknown coverage_mode: {}".format(coverage_mode))
 
 # Finds itemsets of all lengths, can add functionality to support min_length or certain length only
-def find_itemsets(current_tree, suffixes_found, output_list, total_transactions, min_support, max_antecedent_length, attribute_indices):
-    reverse_ordering = sorted(list(current_tree.item_counts.keys()), key=current_tree.item_counts.get)
-        
-    for attribute in reverse_ordering:
-            
-        nodes = current_tree.item_nodes[attribute]
+# Items are ranks, itemsets are appended to output_list with the suffix item first and their support counts to output_supports
+def find_itemsets(current_tree, suffixes_found, output_list, output_supports, total_transactions, min_support, max_antecedent_length):
+    if max_antecedent_length < 1:
+        return
+
+    # Least frequent first, ties broken by the item ranked last globally
+    reverse_ordering = sorted(current_tree.present_items(), key=lambda rank: (current_tree.item_counts[rank], -rank))
+
+    for rank in reverse_ordering:
 
         # Check for support
-        support = current_tree.item_counts[attribute] / total_transactions
-        
-        if support >= min_support and attribute not in suffixes_found:
-            new_suffix_set = [attribute]
+        support = current_tree.item_counts[rank] / total_transactions
+
+        if support >= min_support:
+            new_suffix_set = [rank]
             new_suffix_set.extend(suffixes_found)
-            
-            if len(new_suffix_set) <= max_antecedent_length:
-            # if len(new_suffix_set) == max_antecedent_length:
-                output_list.append(new_suffix_set)
-            
-            conditional_tree = create_conditional_tree(current_tree.get_prefix_paths(attribute))
-            find_itemsets(conditional_tree, new_suffix_set, output_list, total_transactions, min_support, max_antecedent_length, attribute_indices)
-    
-# Create a conditional tree using paths generated from get_prefix_paths
-def create_conditional_tree(paths):
-    tree = FP_Tree()
-    conditional_attribute = paths[0][-1].attribute # Paths are from root to end
-    # For each path, parent starts as tree.root 
-    current_parent = tree.root
-    
-    for path in paths:
-        for node in path:
-            attr = node.attribute
-            # count is 0 unless it is the attribute of interest
-            count = 0
-            if attr == conditional_attribute:
-                count = node.count
-            
-            # Check if current_parent already has a child with given attr, otherwise create a new node to mimic it
-            attr_node = next( (node for node in current_parent.child_list if node.attribute == attr), None)
-
-            # All we have to do is switch because we want 0 counts
-            if attr_node is not None:
-                current_parent = attr_node
-            else:
-                new_node = FP_Node(attr, count, current_parent)
-                current_parent.child_list.append(new_node)
-                
-                # Add the new node to the tree record
-                if attr in tree.item_nodes[attr]:
-                    tree.item_nodes[attr][-1].neighbor = attr
-                    
-                tree.item_nodes[attr].append(new_node)
-                current_parent = new_node
-            
-            # Will modify only for the conditional
-            tree.item_counts[attr] += count
-                
-        # reset for next root
-        current_parent = tree.root
-        
-    # Once constructed, get the prefix paths and add one to each element in each prefix path
-    paths = tree.get_prefix_paths(conditional_attribute)
-    for path in paths:
-        
-        count_to_add = path[-1].count
-        
-        for node in path:
-            cur_attr = node.attribute
-            if cur_attr != conditional_attribute:
-                node.count += count_to_add
-                tree.item_counts[cur_attr] += count_to_add
-                
-    # After getting the conditional tree, prune all the nodes of the conditional attribute
-    
-    for cond_node in tree.item_nodes[conditional_attribute]:
-        parent = cond_node.parent
-        parent.child_list = []
-        
-    del tree.item_counts[conditional_attribute]
-    del tree.item_nodes[conditional_attribute]
-    
-    # Might want to prune nodes that don't meet support but can probably just do that externally with checks    
+
+            output_list.append(new_suffix_set)
+            output_supports.append(current_tree.item_counts[rank])
+
+            # Longer itemsets would exceed the maximum length, so don't build the conditional tree
+            if len(new_suffix_set) < max_antecedent_length:
+                conditional_tree = create_conditional_tree(current_tree.get_prefix_paths(rank), current_tree.num_items, total_transactions, min_support)
+                find_itemsets(conditional_tree, new_suffix_set, output_list, output_supports, total_transactions, min_support, max_antecedent_length)
+
+# Same output as find_itemsets from the root, with each top-level conditional pattern base mined in a process pool
+def find_itemsets_parallel(fp_tree, output_list, output_supports, total_transactions, min_support, max_antecedent_length, n_jobs):
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+
+    reverse_ordering = sorted(fp_tree.present_items(), key=lambda rank: (fp_tree.item_counts[rank], -rank))
+    frequent_ranks = [rank for rank in reverse_ordering if fp_tree.item_counts[rank] / total_transactions >= min_support]
+    if max_antecedent_length < 1:
+        return
+    pattern_bases = {rank: fp_tree.get_prefix_paths(rank) for rank in frequent_ranks}
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+
+        # Submit the largest pattern bases first so they do not straggle at the end
+        futures = {}
+        for rank in sorted(frequent_ranks, key=lambda rank: -sum(len(path) for path, count in pattern_bases[rank])):
+            futures[rank] = executor.submit(mine_conditional_base, pattern_bases[rank], fp_tree.num_items, [rank], total_transactions, min_support, max_antecedent_length)
+
+        # Merge in the serial order so the output does not depend on scheduling
+        for rank in frequent_ranks:
+            output_list.append([rank])
+            output_supports.append(fp_tree.item_counts[rank])
+            itemsets, supports = futures[rank].result()
+            output_list.extend(itemsets)
+            output_supports.extend(supports)
+
+# Worker for find_itemsets_parallel, mines the conditional tree of one suffix
+def mine_conditional_base(paths, num_items, suffix, total_transactions, min_support, max_antecedent_length):
+    output_list = []
+    output_supports = []
+    if len(suffix) < max_antecedent_length:
+        conditional_tree = create_conditional_tree(paths, num_items, total_transactions, min_support)
+        find_itemsets(conditional_tree, suffix, output_list, output_supports, total_transactions, min_support, max_antecedent_length)
+    return output_list, output_supports
+
+# Packed bitset of the rows containing each ranked item
+def create_item_bitsets(data_matrix, sorted_items, item_dictionary):
+    item_rows = np.zeros((len(sorted_items), len(data_matrix)), dtype=bool)
+    for rank, code in enumerate(sorted_items):
+        item_rows[rank] = data_matrix[:, item_dictionary.column(code)] == code
+    return np.packbits(item_rows, axis=1)
+
+# Eclat counterpart of find_itemsets, extends the suffix depth first with candidate ranks by intersecting row bitsets.
+# Visits itemsets in the same order as find_itemsets and also appends the rows covered by each output itemset.
+def find_itemsets_vertical(item_bitsets, candidates, suffixes_found, suffix_bitset, output_list, output_supports, output_bitsets, total_transactions, min_support, max_antecedent_length):
+    if len(suffixes_found) >= max_antecedent_length or len(candidates) == 0:
+        return
+
+    candidate_bitsets = item_bitsets[candidates] & suffix_bitset
+    supports = POPCOUNT_TABLE[candidate_bitsets].sum(axis=1)
+
+    # Least frequent first, ties broken by the item ranked last globally
+    frequent = [(supports[i], rank, candidate_bitsets[i]) for i, rank in enumerate(candidates) if supports[i] / total_transactions >= min_support]
+    frequent.sort(key=lambda entry: (entry[0], -entry[1]))
+
+    for support, rank, bitset in frequent:
+        new_suffix_set = [rank]
+        new_suffix_set.extend(suffixes_found)
+
+        output_list.append(new_suffix_set)
+        output_supports.append(int(support))
+        output_bitsets.append(bitset)
+
+        # Only items ranked before this one can extend it, as in the conditional tree
+        new_candidates = sorted(other for _, other, _ in frequent if other < rank)
+        find_itemsets_vertical(item_bitsets, new_candidates, new_suffix_set, bitset, output_list, output_supports, output_bitsets, total_transactions, min_support, max_antecedent_length)
+
+# Create a conditional tree from the (path, count) pairs generated by get_prefix_paths
+# Items without minimum support in the pattern base are dropped before the tree is built
+def create_conditional_tree(paths, num_items, total_transactions, min_support):
+    item_counts = defaultdict(int)
+    for path, count in paths:
+        for rank in path:
+            item_counts[rank] += count
+
+    tree = FP_Tree(num_items)
+    for path, count in paths:
+        tree.insert([rank for rank in path if item_counts[rank] / total_transactions >= min_support], count)
     return tree
 
-class FP_Node:
-    
-    # attribute
-    # count
-    # child list
-    
-    def __init__(self, attribute, count, parent):
-        
-        self.attribute = attribute
-        self.count = count
-        self.parent = parent
-        self.child_list = []
-        self.neighbor = None
-        
-class FP_Tree:
-    
-    # item_table - attribute to (count, pointer_to_tree)
-    # root - null node
-    
-    def __init__(self):
-        self.root = FP_Node(None, 0, None)
-        self.item_counts = defaultdict(int)
-        self.item_nodes = defaultdict(list) # Ordered by insertion into tree
-    
-    # Helper method for constructing prefix path trees
-    def add_node(self, attribute, count, parent_node):
-        
-        new_node = FP_Node(attribute, count, parent_node)    
-        parent_node.child_list.append(new_node)
-    
-        self.item_counts[attribute] += count
-        
-        if attribute in self.item_nodes:
-            # Mark neighbor of most recent node of same attribute
-            # Only time we set neighbors
-            self.item_nodes[attribute][-1].neighbor = new_node
-                
-        self.item_nodes[attr_to_insert].append(attr_node) # Add new node to item_nodes
-      
-
-    # Starting from an end node get the path of the node
-    # Helper method for getting all paths ending with a given attribute
-    # Each path starts with the root
-    def collect_path(self, node):
-        
-        path = []
-        
-        current_node = node
-        while current_node.parent is not None: # While not root
-            path.append(current_node)
-            current_node = current_node.parent # move up to parent
-        
-#         path.append(current_node) # Append the root
-        path.reverse()
-        
-        return path
-        
-    def get_prefix_paths(self, attribute):
-        
-        attribute_nodes = self.item_nodes[attribute]
-        all_paths = [self.collect_path(node) for node in attribute_nodes]
-        
-        return all_paths
-        
-    def insert_list(self, item_list, parent_node):
-                
-        # Base case
-        if len(item_list) == 0:
+# Indices of the itemsets to keep for the given itemset_mode and min_antecedent_length
+def filter_itemsets(itemsets, supports, itemset_mode, min_antecedent_length):
+    if itemset_mode == "all":
+        return [i for i, itemset in enumerate(itemsets) if len(itemset) >= min_antecedent_length]
+    elif itemset_mode not in ("closed", "maximal"):
+        raise ValueError("Unknown itemset_mode: {}".format(itemset_mode))
+
+    itemset_indices = {frozenset(itemset): i for i, itemset in enumerate(itemsets)}
+
+    # Every itemset with a frequent superset one item longer is dominated, closed mode also requires equal support
+    dominated = set()
+    for i, itemset in enumerate(itemsets):
+        if len(itemset) < 2:
+            continue
+        items = frozenset(itemset)
+        for item in itemset:
+            subset_index = itemset_indices[items - {item}]
+            if itemset_mode == "maximal" or supports[subset_index] == supports[i]:
+                dominated.add(subset_index)
+
+    return [i for i, itemset in enumerate(itemsets) if i not in dominated and len(itemset) >= min_antecedent_length]
+
+class FP_Tree(object):
+    '''
+    FP-Tree stored as flat parallel arrays indexed by node id, node 0 is the root.
+    Items are integer ranks in [0, num_items), transactions are inserted in ascending rank order.
+
+    parents, items, counts - parent node, item rank and count of each node
+    node_links - next node holding the same item, -1 at the end of the chain
+    item_heads - first node holding each item, -1 if the item is absent
+    children - maps node_id * num_items + rank to the child of node_id holding rank
+    '''
+    def __init__(self, num_items):
+        self.num_items = num_items
+        self.parents = array('i', [-1])
+        self.items = array('i', [-1])
+        self.counts = array('q', [0])
+        self.node_links = array('i', [-1])
+        self.item_heads = array('i', [-1]) * num_items
+        self.item_tails = array('i', [-1]) * num_items
+        self.item_counts = array('q', [0]) * num_items
+        self.children = {}
+
+    def present_items(self):
+        return [rank for rank in range(self.num_items) if self.item_heads[rank] != -1]
+
+    def insert(self, ranks, count=1):
+        node = 0
+        for rank in ranks:
+            key = node * self.num_items + rank
+            child = self.children.get(key)
+
+            if child is None:
+                child = len(self.items)
+                self.parents.append(node)
+                self.items.append(rank)
+                self.counts.append(0)
+                self.node_links.append(-1)
+                self.children[key] = child
+
+                # Link the new node at the end of the chain for its item
+                if self.item_heads[rank] == -1:
+                    self.item_heads[rank] = child
+                else:
+                    self.node_links[self.item_tails[rank]] = child
+                self.item_tails[rank] = child
+
+            self.counts[child] += count
+            self.item_counts[rank] += count
+            node = child
+
+    # All paths ending with a given item, as (ranks from the root down to the item's parent, count of the item's node)
+    def get_prefix_paths(self, rank):
+        paths = []
+        node = self.item_heads[rank]
+        while node != -1:
+            path = []
+            parent = self.parents[node]
+            while parent > 0: # While not root
+                path.append(self.items[parent])
+                parent = self.parents[parent]
+            path.reverse()
+            paths.append((path, self.counts[node]))
+            node = self.node_links[node]
+        return paths
+
+class IncrementalMiner(object):
+    '''
+    Persistent miner for training data that arrives in batches, maintained the FUP way. Keeps the support of
+    every frequent itemset and of its negative border, the itemsets that are not frequent but whose subsets one
+    item shorter all are, and the packed rows containing each item in every batch. Adding rows counts only the
+    tracked itemsets, over only the new rows. Itemsets that crossed the threshold are extended when the
+    AntecedentGroup is next asked for, and only the candidates that were not tracked yet are counted over the
+    earlier batches, so a refresh costs time in proportion to the new rows unless the frequent itemsets change.
+    '''
+    def __init__(self, min_support_threshold, max_antecedent_length, item_dictionary=None):
+        self.min_support_threshold = min_support_threshold
+        self.max_antecedent_length = max_antecedent_length
+        self.item_dictionary = item_dictionary if item_dictionary is not None else ItemDictionary()
+        self.batch_bitsets = [] # item code -> packed rows of the batch containing it, for every batch added
+        self.num_samples = 0
+        self.supports = {} # itemset (tuple of increasing codes) -> support, for the frequent itemsets and their border
+        self.frequent_itemsets = []
+        self.stale = False # whether rows were added since frequent_itemsets was derived
+
+    def add_transactions(self, data_matrix, encoded=False):
+        '''
+        data_matrix - new raw rows, or rows already encoded with self.item_dictionary if encoded is True
+        '''
+        if not encoded:
+            data_matrix = self.item_dictionary.encode(data_matrix, extend=True)
+        data_matrix = np.asarray(data_matrix, dtype=np.int32)
+        if len(data_matrix) == 0:
             return
-        else:
-            
-            attr_to_insert = item_list[0]
-            
-            # If parent_node has a direct child with same attribute name then increment
-            attr_node = next( (node for node in parent_node.child_list if node.attribute == attr_to_insert), None)
-            
-            # Else create a new node with provided parent node (link both ways)
-            if attr_node is None:
-                
-                attr_node = FP_Node(attr_to_insert, 1, parent_node)
-                parent_node.child_list.append(attr_node)
-                
-                if attr_to_insert in self.item_nodes:
-                    # Mark neighbor of most recent node of same attribute
-                    # Only time we set neighbors
-                    self.item_nodes[attr_to_insert][-1].neighbor = attr_node
-                
-                self.item_nodes[attr_to_insert].append(attr_node) # Add new node to item_nodes
-              
-            else:
-                attr_node.count += 1
-            
-            self.item_counts[attr_to_insert] += 1 # Increment item count            
-                
-            # Recursively call the rest of the list
-            # Parent node either a newly created node or an existing child
-            self.insert_list(item_list[1:], attr_node)        
\ No newline at end of file
+
+        item_bitsets = create_item_bitsets(data_matrix, range(len(self.item_dictionary)), self.item_dictionary)
+
+        # Every single item is tracked, those that are not frequent are in the border
+        for code in range(len(self.item_dictionary)):
+            self.supports.setdefault((code,), 0)
+        itemsets = list(self.supports)
+        for itemset, support in zip(itemsets, count_itemsets(item_bitsets, itemsets)):
+            self.supports[itemset] += support
+
+        self.batch_bitsets.append(item_bitsets)
+        self.num_samples += len(data_matrix)
+        self.stale = True
+
+    def update_itemsets(self):
+        '''
+        Derives the frequent itemsets level by level from the tracked supports. Candidates that were not tracked,
+        because one of their subsets just crossed the threshold, are counted over every batch. Tracked itemsets that
+        are no longer frequent or in the border are dropped.
+        '''
+        supports = {itemset: support for itemset, support in self.supports.items() if len(itemset) == 1}
+
+        # Single items must clear the threshold strictly, as in rank_items
+        frequent = [itemset for itemset in sorted(supports) if supports[itemset] / self.num_samples > self.min_support_threshold]
+        if self.max_antecedent_length < 1:
+            frequent = []
+        self.frequent_itemsets = list(frequent)
+
+        length = 1
+        while frequent and length < self.max_antecedent_length:
+            candidates = extend_itemsets(frequent)
+            new_candidates = [itemset for itemset in candidates if itemset not in self.supports]
+            new_supports = [0] * len(new_candidates)
+            for item_bitsets in self.batch_bitsets:
+                new_supports = [support + batch_support for support, batch_support in zip(new_supports, count_itemsets(item_bitsets, new_candidates))]
+            supports.update(zip(new_candidates, new_supports))
+
+            for itemset in candidates:
+                if itemset not in supports:
+                    supports[itemset] = self.supports[itemset]
+            frequent = [itemset for itemset in candidates if supports[itemset] / self.num_samples >= self.min_support_threshold]
+            self.frequent_itemsets.extend(frequent)
+            length += 1
+
+        self.supports = supports
+
+    def get_antecedent_group(self, itemset_mode="all", min_antecedent_length=1, data_matrix=None, coverage_mode="auto", max_coverage_bytes=MAX_COVERAGE_BYTES):
+        '''
+        AntecedentGroup of the itemsets frequent over every row added so far, with the same antecedents as
+        generate_antecedent_list on the concatenated rows. Pass the encoded rows as data_matrix to build a coverage index.
+        '''
+        if self.stale:
+            self.update_itemsets()
+            self.stale = False
+
+        output_itemsets = [list(itemset) for itemset in self.frequent_itemsets]
+        output_supports = [self.supports[itemset] for itemset in self.frequent_itemsets]
+
+        kept_indices = filter_itemsets(output_itemsets, output_supports, itemset_mode, min_antecedent_length)
+        output_itemsets = [output_itemsets[i] for i in kept_indices]
+
+        # Items are ranked by their own code
+        all_antecedents = create_antecedent_group(output_itemsets, list(range(len(self.item_dictionary))), self.item_dictionary)
+        if data_matrix is not None:
+            all_antecedents.coverage = build_coverage_index(all_antecedents.antecedents, data_matrix, coverage_mode, max_coverage_bytes)
+
+        return all_antecedents
+
+def extend_itemsets(frequent):
+    '''
+    Candidate itemsets one item longer than those of frequent, every subset of which one item shorter is in frequent.
+    As in Apriori they join pairs of frequent itemsets sharing all but their last item. Itemsets are tuples of
+    increasing item codes.
+    '''
+    frequent_set = set(frequent)
+    last_items = defaultdict(list)
+    for itemset in frequent:
+        last_items[itemset[:-1]].append(itemset[-1])
+
+    candidates = []
+    for prefix in sorted(last_items):
+        items = sorted(last_items[prefix])
+        for i, first in enumerate(items):
+            for second in items[i + 1:]:
+                candidate = prefix + (first, second)
+                # The subsets missing one of the last two items are the ones joined
+                if all(candidate[:j] + candidate[j + 1:] in frequent_set for j in range(len(candidate) - 2)):
+                    candidates.append(candidate)
+    return candidates
+
+def count_itemsets(item_bitsets, itemsets):
+    '''
+    Number of rows of a batch containing every item of each itemset, itemsets being tuples of item codes and
+    item_bitsets the packed rows of the batch containing each code. Codes past the end of item_bitsets were
+    added to the dictionary after the batch, so no row contains them.
+    '''
+    supports = [0] * len(itemsets)
+    indices_by_length = defaultdict(list)
+    for i, itemset in enumerate(itemsets):
+        indices_by_length[len(itemset)].append(i)
+
+    for length, indices in indices_by_length.items():
+        codes = np.array([itemsets[i] for i in indices], dtype=np.int64).reshape(len(indices), length)
+        present = (codes < len(item_bitsets)).all(axis=1)
+        indices = [i for i, is_present in zip(indices, present) if is_present]
+        codes = codes[present]
+        for start in range(0, len(indices), ITEMSET_COUNT_BATCH_SIZE):
+            rows = np.bitwise_and.reduce(item_bitsets[codes[start:start + ITEMSET_COUNT_BATCH_SIZE]], axis=1)
+            for i, support in zip(indices[start:start + ITEMSET_COUNT_BATCH_SIZE], POPCOUNT_TABLE[rows].sum(axis=1).tolist()):
+                supports[i] = support
+    return supports
@@ -68,16 +68,20 @@ def compute_dirichlet_confidence_interval(concentration_parameters, index_to_com
 
 
 def find_brl_point(generated_mcmc_samples, data_matrix, outcomes, all_antecedents, alpha, lmda, eta):
-
-    antecedent_list_lengths = [ant_list.length() for ant_list in generated_mcmc_samples]
-    average_antecedent_list_length = sum(antecedent_list_lengths) / len(antecedent_list_lengths)
-
-    num_antecedents = sum(antecedent_list_lengths)
+    '''
+    generated_mcmc_samples - PosteriorSamples from brl_metropolis_hastings, a SampleStore, or a list of sampled antecedent lists
+    '''
+    # Every distinct list once, weighted by the number of samples the chain dwelled on it
+    weighted_lists = weighted_samples(generated_mcmc_samples, all_antecedents)
+    num_samples = sum(count for ant_list, count in weighted_lists)
+
+    num_antecedents = sum(ant_list.length() * count for ant_list, count in weighted_lists)
+    average_antecedent_list_length = num_antecedents / num_samples
     total_cardinality = 0
 
-    for ant_list in generated_mcmc_samples:
+    for ant_list, count in weighted_lists:
         for ant in ant_list.antecedents:
-            total_cardinality += ant.length() 
+            total_cardinality += ant.length() * count
 
     average_cardinality = total_cardinality / num_antecedents
 
@@ -89,25 +93,27 @@ def find_brl_point(generated_mcmc_samples, data_matrix, outcomes, all_antecedent
 
     print("List Length Bounds", antecedent_list_length_bounds)
 
-    # Go through all the lists to get the highest posterior list 
+    # Go through all the lists to get the highest posterior list, shares scores with the sampler through the PosteriorModel memo
+    posterior = PosteriorModel.for_data(data_matrix, outcomes, all_antecedents, alpha, lmda, eta)
     brl_point_list = None
-    highest_posterior_probability = 0.0
+    highest_log_posterior = -math.inf
 
-    for antecedent_list in generated_mcmc_samples:
+    for antecedent_list, count in weighted_lists:
 
         average_cardinality = antecedent_list.get_average_cardinality()
         list_length = antecedent_list.length()
         
         if (average_cardinality >= antecedent_cardinality_bounds[0] and average_cardinality <= antecedent_cardinality_bounds[1]) and (list_length >= antecedent_list_length_bounds[0] and list_length <= antecedent_list_length_bounds[1]):
 
-            # Take exponential because we do all probabilities using logs
-            posterior_probability = math.exp(p_d_given_data(antecedent_list, data_matrix, outcomes, all_antecedents, alpha, lmda, eta))
+            # Compare in log space, the posterior probabilities themselves can underflow
+            log_posterior = posterior.score(antecedent_list)
 
-            if posterior_probability > highest_posterior_probability:
-                highest_posterior_probability = posterior_probability
+            if log_posterior > highest_log_posterior:
+                highest_log_posterior = log_posterior
                 brl_point_list = antecedent_list
 
-    return brl_point_list, highest_posterior_probability
+    # Take exponential because we do all probabilities using logs
+    return brl_point_list, math.exp(highest_log_posterior)
 
 def brl_point_predict(x_test_sample, N_posterior, antecedent_list, alpha, probability_threshold=0.5):
 
@@ -127,6 +133,41 @@ def brl_point_predict(x_test_sample, N_posterior, antecedent_list, alpha, probab
         return posterior_dirichlet_parameter.index(max(posterior_dirichlet_parameter))
 
 
+def brl_model_average_probabilities(data_test, generated_mcmc_samples, data_matrix, outcomes, all_antecedents, alpha):
+    '''
+    Posterior predictive label probabilities of every test sample, averaging the predictions of every sampled
+    list weighted by its number of samples instead of using a single point list
+
+    generated_mcmc_samples - PosteriorSamples, SampleStore or list of sampled antecedent lists
+    data_matrix, outcomes - training data the label counts of each list's rules come from
+    '''
+    likelihood = LikelihoodModel.for_data(data_matrix, outcomes, all_antecedents, alpha)
+    test_coverage = LazyCoverageIndex(all_antecedents.antecedents, encode_rows(data_test, all_antecedents.item_dictionary), all_antecedents.length())
+
+    probabilities = np.zeros((len(data_test), len(alpha)))
+    total_count = 0
+    for antecedent_list, count in weighted_samples(generated_mcmc_samples, all_antecedents):
+        # Training label counts captured by each antecedent, the last row for the default rule
+        posterior_dirichlet_parameters = np.array(likelihood.create_state(antecedent_list.get_ids()).counts) + np.asarray(alpha)
+        label_probabilities = posterior_dirichlet_parameters / posterior_dirichlet_parameters.sum(axis=1, keepdims=True)
+
+        probabilities += count * label_probabilities[antecedent_list.get_first_antecedent_indices(test_coverage)]
+        total_count += count
+
+    return probabilities / total_count
+
+def brl_model_average_predict(data_test, generated_mcmc_samples, data_matrix, outcomes, all_antecedents, alpha, probability_threshold=0.5):
+    '''
+    Labels predicted from brl_model_average_probabilities, thresholded like brl_point_predict
+    '''
+    probabilities = brl_model_average_probabilities(data_test, generated_mcmc_samples, data_matrix, outcomes, all_antecedents, alpha)
+
+    if len(alpha) == 2:
+        return (probabilities[:, 1] > probability_threshold).astype(int)
+
+    # For multilabel
+    return probabilities.argmax(axis=1)
+
 def make_brl_test_set_predictions(data_test, outcome_test, N_posterior, brl_point_list, alpha, threshold, verbose=True):
 
     predictions = [brl_point_predict(test_sample, N_posterior, brl_point_list, alpha, probability_threshold=threshold) for test_sample in data_test]
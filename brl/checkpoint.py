@@ -0,0 +1,63 @@
+import os
+import pickle
+import tempfile
+
+from .samples import *
+
+class ChainSnapshot(object):
+    '''
+    Resumable state of one chain: its current list, random stream state, proposals accepted since the last check
+    and AntecedentPool, whose order decides which antecedents the random stream draws
+    '''
+    def __init__(self, ids, rng_state, accepted, pool=None):
+        self.ids = ids
+        self.rng_state = rng_state
+        self.accepted = accepted
+        self.pool = pool
+
+class SamplerCheckpoint(object):
+    '''
+    Everything brl_metropolis_hastings needs to continue a run exactly where it was saved
+
+    iterations - iterations run so far, including burn in
+    chains - ChainSnapshot of every chain
+    samples - PosteriorSamples so far, whose traces are also what the diagnostics are recomputed from. Samples
+        spilled to files are not copied into the checkpoint, those files have to be kept to resume from it.
+    finished - whether the run had stopped on convergence or after its extra iterations, rather than on its budget
+        or being cancelled. Resuming such a run without extra_iterations returns its samples as saved.
+    settings - sampler arguments the run must be resumed with, see sampler_settings
+    '''
+    def __init__(self, iterations, chains, samples, finished, settings):
+        self.iterations = iterations
+        self.chains = chains
+        self.samples = samples
+        self.finished = finished
+        self.settings = settings
+
+    def num_chains(self):
+        return len(self.chains)
+
+    def check_settings(self, settings):
+        for name, value in settings.items():
+            if self.settings.get(name) != value:
+                raise ValueError("Checkpoint was saved with {}={}, cannot resume with {}".format(name, self.settings.get(name), value))
+
+def sampler_settings(all_antecedents, alpha, lmda, eta, burn_in, thin, num_tries, checkpoint_interval, min_num_iterations, convergence_threshold, target_ess):
+    '''
+    Arguments that change the chains' trajectories or samples, or when the run stops, so a run has to be resumed
+    with the same ones
+    '''
+    return {"num_antecedents": all_antecedents.length(), "alpha": list(alpha), "lmda": lmda, "eta": eta, "burn_in": burn_in, "thin": thin, "num_tries": num_tries,
+            "checkpoint_interval": checkpoint_interval, "min_num_iterations": min_num_iterations, "convergence_threshold": convergence_threshold, "target_ess": target_ess}
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    # Write to a temporary file first so a crash while saving keeps the previous checkpoint intact
+    checkpoint_dir = os.path.dirname(os.path.abspath(checkpoint_path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=checkpoint_dir, suffix=".ckpt")
+    with os.fdopen(file_descriptor, "wb") as temp_file:
+        pickle.dump(checkpoint, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, checkpoint_path)
+
+def load_checkpoint(checkpoint_path):
+    with open(checkpoint_path, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,136 @@
+import math
+import numpy as np
+from scipy.stats import norm, rankdata
+
+# Fewest draws per split half the diagnostics are computed on, below it they are nan
+MIN_SPLIT_DRAWS = 4
+
+def split_chains(traces):
+    '''
+    traces - (chains, draws) array, split into (2 * chains, draws // 2) dropping the middle draw if draws is odd
+    '''
+    traces = np.asarray(traces, dtype=float)
+    half = traces.shape[1] // 2
+    return np.concatenate([traces[:, :half], traces[:, traces.shape[1] - half:]])
+
+def rank_normalize(traces):
+    '''
+    Normal scores of the ranks of all draws pooled together, as in Vehtari et al. (2021)
+    '''
+    ranks = rankdata(traces, method="average").reshape(traces.shape)
+    return norm.ppf((ranks - 0.375) / (traces.size + 0.25))
+
+def rhat(traces):
+    '''
+    Potential scale reduction sqrt(var+ / W) of (chains, draws) traces
+    '''
+    num_draws = traces.shape[1]
+    within = traces.var(axis=1, ddof=1).mean()
+    if within == 0:
+        return math.nan
+    between = num_draws * traces.mean(axis=1).var(ddof=1)
+    var_plus = (num_draws - 1) / num_draws * within + between / num_draws
+    return math.sqrt(var_plus / within)
+
+def split_rhat(traces):
+    '''
+    Rank normalized split R-hat, the larger of the bulk and the folded (tail) versions. nan if the chains are too short.
+    '''
+    split = split_chains(traces)
+    if split.shape[1] < MIN_SPLIT_DRAWS:
+        return math.nan
+    folded = np.abs(split - np.median(split))
+    return max(rhat(rank_normalize(split)), rhat(rank_normalize(folded)))
+
+def autocovariance(traces):
+    '''
+    Autocovariance of every chain at every lag, computed with an FFT
+    '''
+    num_draws = traces.shape[1]
+    centered = traces - traces.mean(axis=1, keepdims=True)
+    size = 1 << (2 * num_draws - 1).bit_length()
+    transform = np.fft.rfft(centered, n=size)
+    return np.fft.irfft(transform * np.conjugate(transform), n=size)[:, :num_draws] / num_draws
+
+def effective_sample_size(traces):
+    '''
+    Multi-chain effective sample size of (chains, draws) traces, truncating the autocorrelations with
+    Geyer's initial monotone sequence
+    '''
+    num_chains, num_draws = traces.shape
+    if num_draws < MIN_SPLIT_DRAWS:
+        return math.nan
+
+    acov = autocovariance(traces)
+    within = acov[:, 0].mean() * num_draws / (num_draws - 1)
+    var_plus = within * (num_draws - 1) / num_draws
+    if num_chains > 1:
+        var_plus += traces.mean(axis=1).var(ddof=1)
+    if var_plus == 0:
+        return math.nan
+
+    rho = 1 - (within - acov.mean(axis=0)) / var_plus
+    rho[0] = 1.0
+
+    # Sums of consecutive even and odd lags, kept up to the first negative one and made non-increasing
+    pairs = rho[:2 * (num_draws // 2)].reshape(-1, 2).sum(axis=1)
+    negative = np.flatnonzero(pairs < 0)
+    if len(negative) > 0:
+        pairs = pairs[:negative[0]]
+    pairs = np.minimum.accumulate(pairs)
+
+    total_draws = num_chains * num_draws
+    tau = max(-1 + 2 * pairs.sum(), 1 / math.log10(total_draws))
+    return total_draws / tau
+
+def bulk_ess(traces):
+    split = split_chains(traces)
+    if split.shape[1] < MIN_SPLIT_DRAWS:
+        return math.nan
+    return effective_sample_size(rank_normalize(split))
+
+def tail_ess(traces):
+    '''
+    Smaller effective sample size of the indicators of the 5% and 95% quantiles
+    '''
+    split = split_chains(traces)
+    if split.shape[1] < MIN_SPLIT_DRAWS:
+        return math.nan
+    lower, upper = np.quantile(split, [0.05, 0.95])
+    return min(effective_sample_size((split <= lower).astype(float)), effective_sample_size((split <= upper).astype(float)))
+
+class Diagnostics(object):
+    '''
+    Convergence diagnostics of a batch of chains
+
+    samples - draws per chain the diagnostics were computed on
+    rhat - rank normalized split R-hat
+    bulk_ess, tail_ess - effective sample sizes over all chains
+    acceptance_rates - fraction of proposals each chain accepted since the previous diagnostics
+    '''
+    def __init__(self, samples, rhat, bulk_ess, tail_ess, acceptance_rates):
+        self.samples = samples
+        self.rhat = rhat
+        self.bulk_ess = bulk_ess
+        self.tail_ess = tail_ess
+        self.acceptance_rates = acceptance_rates
+
+    def ess(self):
+        return min(self.bulk_ess, self.tail_ess)
+
+    def converged(self, rhat_threshold, target_ess=None):
+        # nan compares False, so chains too short or stuck never count as converged
+        if not self.rhat < rhat_threshold:
+            return False
+        return target_ess is None or self.ess() >= target_ess
+
+    def summary(self):
+        return "Samples: %d R-hat: %.4f Bulk ESS: %.1f Tail ESS: %.1f Acceptance: %s" % (self.samples, self.rhat, self.bulk_ess, self.tail_ess, " ".join("%.3f" % rate for rate in self.acceptance_rates))
+
+def diagnose(traces, acceptance_rates):
+    '''
+    traces - (chains, draws) log posterior of every chain after every iteration past burn in
+    acceptance_rates - per chain acceptance rate to report alongside
+    '''
+    traces = np.asarray(traces, dtype=float)
+    return Diagnostics(traces.shape[1], split_rhat(traces), bulk_ess(traces), tail_ess(traces), list(acceptance_rates))
@@ -1,43 +1,51 @@
 import math
+import weakref
+import numpy as np
 import pandas as pd
+from scipy.special import gammaln
 import random
 from .utils import *
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import time
 
 OPTIMIZATION_THRESHOLD = 10
 
-def generate_default_antecedent_list(all_antecedents, lmda, eta):
+def generate_default_antecedent_list(all_antecedents, lmda, eta, prior_cache=None, rng=random, pool=None):
 
     '''
     lmda - parameter for Poisson distribution for selecting length of the antecedent list
     eta - parameter for Poisson distribution for selecting cardinality of each antecedent
+    prior_cache - PriorCache of all_antecedents, lmda and eta, saves recomputing p_m for every length
+    rng - random.Random stream to sample with, the random module by default
+    pool - AntecedentPool to draw the antecedents from, left excluding the sampled list, a new one by default
     '''
 
-    p_list = random.random()
+    p_list = rng.random()
     sum = 0.0
     sampled_antecedent_list_length = None
 
     # Sample the length of the antecedent list, truncated Poisson
     for m in range(1, all_antecedents.length()+1):
-        sum += math.exp(p_m(m, all_antecedents, lmda))
+        sum += math.exp(prior_cache.log_p_m[m] if prior_cache is not None else p_m(m, all_antecedents, lmda))
         if sum > p_list:
             sampled_antecedent_list_length = m
             break
 
     print("Sampled Antecedent List Length:", sampled_antecedent_list_length, "Total Number Antecedents", all_antecedents.length())
 
+    if pool is None:
+        pool = AntecedentPool(all_antecedents)
+
     antecedent_list = []
-    indices_selected_by_length = defaultdict(set) #maps lengths to indices already selected, for ensuring we do not select duplicates
-    # antecedent_lengths_exhausted = []
-    available_antecedent_sizes = list(all_antecedents.sizes())
+    # Antecedents are drawn from the pool and taken out of it, so no antecedent is selected twice
+    available_antecedent_sizes = [size for size in all_antecedents.sizes() if pool.length_of_size(size) > 0]
     print("Available Antecedent Sizes:", available_antecedent_sizes)
 
     number_of_lists_sampled = 0.0
     while number_of_lists_sampled < sampled_antecedent_list_length:
         # For each antecedent in the list, sample the cardinality and get from all_antecedents
         
-        p_card = random.random()
+        p_card = rng.random()
         sum = 0.0
         sampled_antecedent_cardinality = None
 
@@ -54,42 +62,163 @@ def generate_default_antecedent_list(all_antecedents, lmda, eta):
 
         # print("Sampled Antecedent Cardinality", sampled_antecedent_cardinality)
 
-        correct_length_antecedents = all_antecedents.get_antecedents_by_length(sampled_antecedent_cardinality)
-        list_of_available_indices = list(set(range(len(correct_length_antecedents))) - indices_selected_by_length[sampled_antecedent_cardinality])
-
-        assert(len(list_of_available_indices) != 0)
+        assert(pool.length_of_size(sampled_antecedent_cardinality) != 0)
 
         # If there's only one available and we select it, mark that there are no more left
-        if len(list_of_available_indices) == 1:
+        if pool.length_of_size(sampled_antecedent_cardinality) == 1:
             # print("Removing cardinality:", sampled_antecedent_cardinality)
             available_antecedent_sizes.remove(sampled_antecedent_cardinality)
 
-        selected_index = random.choice(list_of_available_indices) # select an index that we haven't already
-        assert selected_index not in indices_selected_by_length[sampled_antecedent_cardinality]
-        indices_selected_by_length[sampled_antecedent_cardinality].add(selected_index)
+        selected_id = pool.sample_of_size(sampled_antecedent_cardinality, rng)
+        pool.remove(selected_id)
 
-        antecedent_list.append(correct_length_antecedents[selected_index])
+        antecedent_list.append(selected_id)
         number_of_lists_sampled += 1
-        
-    # print("Indices selected by cardinality length:", indices_selected_by_length)
 
-    return AntecedentList(antecedent_list)
+    return RuleList(all_antecedents, antecedent_list)
 
 # proportional to p(y|x,d,alpha)
-def p_y(y, x, d, alpha):
-    n = [[0 for col in range(len(alpha))] for row in range(d.length() + 1)]
-    for i in range(len(x)):
-        # print("Indices (must be numbers):", d.get_first_antecedent_index(x[i]), y[i])
-        n[d.get_first_antecedent_index(x[i])][y[i]] += 1
-
-    log_prod = 0
-    for i in range(d.length() + 1):
-        sum_i = 0
-        for j in range(len(alpha)):
-            sum_i += n[i][j] + alpha[j]
-            log_prod += math.log(math.factorial(n[i][j] + alpha[j] - 1))
-        log_prod -= math.log(math.factorial(sum_i - 1))
-    return log_prod
+def p_y(y, x, d, alpha, coverage=None):
+    '''
+    coverage - optional CoverageIndex over the rows of x, used to find every row's first antecedent at once
+    '''
+    if coverage is not None:
+        first_indices = d.get_first_antecedent_indices(coverage)
+    else:
+        first_indices = np.array([d.get_first_antecedent_index(sample) for sample in x], dtype=np.intp)
+
+    n = capture_label_counts(first_indices, y, d.length() + 1, len(alpha))
+    return dirichlet_multinomial_log_likelihood(n, alpha)
+
+def capture_label_counts(first_indices, y, num_rules, num_labels):
+    '''
+    Count matrix n[i][j] of the samples with label j whose first applying antecedent is i
+    '''
+    flat_indices = np.asarray(first_indices, dtype=np.intp) * num_labels + np.asarray(y, dtype=np.intp)
+    return np.bincount(flat_indices, minlength=num_rules * num_labels).reshape(num_rules, num_labels)
+
+def dirichlet_multinomial_log_likelihood(n, alpha):
+    '''
+    Sum over the rows of n of log(prod_j (n_ij + alpha_j - 1)! / (sum_j (n_ij + alpha_j) - 1)!), using log Gamma(k) = log (k-1)!
+    '''
+    n_plus_alpha = n + np.asarray(alpha)
+    return float(gammaln(n_plus_alpha).sum() - gammaln(n_plus_alpha.sum(axis=1)).sum())
+
+class CaptureState(object):
+    '''
+    Capture bookkeeping of one antecedent list over the training rows, lets the likelihood of a list
+    that only differs after some position be computed from that position on
+
+    ids - antecedent ids of the list, length m
+    remaining - remaining[k] is the packed bitset of the rows no antecedent before position k applies to, length m + 1
+    counts - counts[k] is the label counts of the rows captured at position k, counts[m] those of the default rule
+    terms - Dirichlet-multinomial log term of each row of counts
+    '''
+    def __init__(self, ids, remaining, counts, terms):
+        self.ids = ids
+        self.remaining = remaining
+        self.counts = counts
+        self.terms = terms
+
+    def log_likelihood(self):
+        # fsum makes the total independent of how the terms were produced
+        return math.fsum(self.terms)
+
+class LikelihoodModel(object):
+    '''
+    p(y|x,d,alpha) over fixed training data, evaluated through the coverage index with CaptureStates
+    '''
+    def __init__(self, coverage, y, alpha):
+        y = np.asarray(y)
+        self.coverage = coverage
+        self.alpha = np.asarray(alpha)
+        self.alpha_sum = self.alpha.sum()
+        self.label_bitsets = np.array([pack_rows(y == label) for label in range(len(alpha))])
+
+    @classmethod
+    def for_data(cls, x, y, a, alpha):
+        coverage = coverage_for_data(a, x)
+        if coverage is None:
+            coverage = CoverageIndex.from_antecedents(a.antecedents, encode_rows(x, getattr(a, "item_dictionary", None)))
+        return cls(coverage, y, alpha)
+
+    def label_counts(self, bitset):
+        return POPCOUNT_TABLE[self.label_bitsets & bitset].sum(axis=1)
+
+    def term(self, counts):
+        return float(gammaln(counts + self.alpha).sum() - gammaln(counts.sum() + self.alpha_sum))
+
+    def create_state(self, ids):
+        return self.update_state(None, ids, 0)
+
+    def update_state(self, state, ids, position):
+        '''
+        CaptureState for the list ids, reusing the entries of state before position. state must
+        belong to a list sharing ids[:position], only the rows reaching position are recounted.
+        '''
+        if state is None:
+            remaining = [full_bitset(self.coverage.num_samples)]
+            counts = []
+            terms = []
+        else:
+            remaining = state.remaining[:position + 1]
+            counts = state.counts[:position]
+            terms = state.terms[:position]
+
+        not_captured = remaining[-1]
+        for antecedent_id in ids[position:]:
+            covered = self.coverage.get_bitset(antecedent_id)
+            captured_counts = self.label_counts(covered & not_captured)
+            counts.append(captured_counts)
+            terms.append(self.term(captured_counts))
+            not_captured = not_captured & ~covered
+            remaining.append(not_captured)
+
+        # Rows no antecedent applies to fall through to the default rule
+        default_counts = self.label_counts(not_captured)
+        counts.append(default_counts)
+        terms.append(self.term(default_counts))
+
+        return CaptureState(ids, remaining, counts, terms)
+
+    def score_batch(self, state, ids_batch, positions):
+        '''
+        log p(y|x,d,alpha) of several lists at once, list k sharing ids_batch[k][:positions[k]] with the list
+        of state. The lists' remaining antecedents are counted together, one position at a time, so each step
+        is a single vectorized pass over the coverage bitsets of every list.
+        '''
+        suffixes = [ids[position:] for ids, position in zip(ids_batch, positions)]
+        max_suffix_length = max(len(suffix) for suffix in suffixes)
+        suffix_ids = np.full((len(suffixes), max_suffix_length), -1, dtype=np.intp)
+        for k, suffix in enumerate(suffixes):
+            suffix_ids[k, :len(suffix)] = suffix
+
+        not_captured = np.array([state.remaining[position] for position in positions])
+
+        # Lists already past their last antecedent cover nothing
+        in_list = suffix_ids >= 0
+        covered = self.coverage.get_bitsets(np.where(in_list, suffix_ids, 0).ravel()).reshape(suffix_ids.shape + not_captured.shape[1:])
+        covered[~in_list] = 0
+
+        # captured[:, t] are the rows each list's t-th new antecedent captures, the last slot the default rule's
+        captured = np.empty((len(suffixes), max_suffix_length + 1, not_captured.shape[1]), dtype=np.uint8)
+        for t in range(max_suffix_length):
+            np.bitwise_and(covered[:, t], not_captured, out=captured[:, t])
+            not_captured &= ~covered[:, t]
+        captured[:, max_suffix_length] = not_captured
+
+        counts = POPCOUNT_TABLE[captured[:, :, None, :] & self.label_bitsets].sum(axis=3)
+        terms = gammaln(counts + self.alpha).sum(axis=2) - gammaln(counts.sum(axis=2) + self.alpha_sum)
+
+        # Summed like CaptureState.log_likelihood so the values match create_state and update_state exactly
+        return [math.fsum(state.terms[:position] + terms[k, :len(suffix)].tolist() + [terms[k, max_suffix_length]]) for k, (suffix, position) in enumerate(zip(suffixes, positions))]
+
+# Position of the first antecedent that differs between two lists of ids, the shorter length if one is a prefix of the other
+def first_difference(ids, other_ids):
+    for position, (antecedent_id, other_id) in enumerate(zip(ids, other_ids)):
+        if antecedent_id != other_id:
+            return position
+    return min(len(ids), len(other_ids))
 
 # product from j=1 to m of p(a_j|a_1,...a_{j-1},a)
 def p_a(d, a):
@@ -103,13 +232,15 @@ def p_a(d, a):
     for size in a.sizes():
         sizes[size] = 0
 
+    lengths_by_size = a.lengths_by_size()
+
     prod = 1.0
     for i in range(d.length()):
         ant_len = d.get_antecedent_by_index(i).length()
 
-        # print(ant_len, a.lengths_by_size()[ant_len], sizes[ant_len])
+        # print(ant_len, lengths_by_size[ant_len], sizes[ant_len])
 
-        prod *= 1.0 / (a.lengths_by_size()[ant_len] - sizes[ant_len])
+        prod *= 1.0 / (lengths_by_size[ant_len] - sizes[ant_len])
         sizes[ant_len] += 1
     return math.log(prod)
 
@@ -164,6 +295,217 @@ def p_d(d, a, lmda, eta):
     """ 
     return p_m(d.length(), a, lmda) + p_c(d, a, eta) + p_a(d, a)
 
+class PriorCache(object):
+    '''
+    log p(d|A,lmda,eta) terms precomputed once for an antecedent pool and hyperparameters. The prior of a list
+    only depends on its length and how many antecedents of each cardinality it holds, since p_a does not
+    depend on their order. A single add/remove/move proposal updates those counts in constant time with
+    proposal_size_counts, and its prior is then one table lookup per cardinality. Proposals are priced from
+    the counts rather than by a delta on the current prior so a list's log prior is the same whichever list
+    it was proposed from, which keeps memoized values and resumed runs exact.
+
+    antecedent_sizes - cardinality of every antecedent in the pool, indexed by antecedent id
+    '''
+    def __init__(self, antecedent_sizes, lmda, eta):
+        self.antecedent_sizes = list(antecedent_sizes)
+        self.lmda = lmda
+        self.eta = eta
+        self.lengths_by_size = defaultdict(int)
+        for size in self.antecedent_sizes:
+            self.lengths_by_size[size] += 1
+        R = len(self.antecedent_sizes)
+
+        # p_m for every list length, truncated Poisson with the same closed form approximation as p_m
+        log_poisson = [m * math.log(lmda) - math.lgamma(m + 1) for m in range(R + 1)]
+        log_truncated_denominator = logsumexp(log_poisson[1:]) if R > 0 else 0.0
+        log_closed_form_denominator = math.log(math.expm1(lmda))
+        self.log_p_m = [log_poisson[m] - (log_closed_form_denominator if R >= OPTIMIZATION_THRESHOLD * m else log_truncated_denominator) for m in range(R + 1)]
+
+        # p_c for every available cardinality
+        log_normalizer = logsumexp([size * math.log(eta) - math.lgamma(size + 1) for size in self.lengths_by_size])
+        self.log_p_c = {size: size * math.log(eta) - math.lgamma(size + 1) - log_normalizer for size in self.lengths_by_size}
+
+        # log_size_terms[c][n] is the p_c and p_a contribution of n antecedents of cardinality c, p_a picks uniformly
+        # among the antecedents of each cardinality not used yet so it contributes log prod_k<n 1 / (R_c - k)
+        self.log_size_terms = {}
+        for size, R_c in self.lengths_by_size.items():
+            self.log_size_terms[size] = [n * self.log_p_c[size] - (math.lgamma(R_c + 1) - math.lgamma(R_c - n + 1)) for n in range(R_c + 1)]
+
+    @classmethod
+    def from_group(cls, a, lmda, eta):
+        return cls(a.antecedent_sizes(), lmda, eta)
+
+    def size_counts(self, ids):
+        counts = defaultdict(int)
+        for antecedent_id in ids:
+            counts[self.antecedent_sizes[antecedent_id]] += 1
+        return counts
+
+    def log_prior(self, ids):
+        return self.log_prior_from_counts(len(ids), self.size_counts(ids))
+
+    def log_prior_from_counts(self, m, size_counts):
+        '''
+        log p(d|A,lmda,eta) of any list of length m with size_counts[c] antecedents of cardinality c
+        '''
+        log_prior = self.log_p_m[m]
+        for size in sorted(size_counts):
+            log_prior += self.log_size_terms[size][size_counts[size]]
+        return log_prior
+
+    def proposal_size_counts(self, ids, proposed_ids, position, size_counts):
+        '''
+        size_counts of proposed_ids, updated from those of ids in constant time
+        '''
+        proposed_size_counts = defaultdict(int, size_counts)
+        if len(proposed_ids) == len(ids) + 1:
+            proposed_size_counts[self.antecedent_sizes[proposed_ids[position]]] += 1
+        elif len(proposed_ids) == len(ids) - 1:
+            proposed_size_counts[self.antecedent_sizes[ids[position]]] -= 1
+        return proposed_size_counts
+
+class PosteriorMemo(object):
+    '''
+    Bounded LRU map from antecedent id tuples to their log posterior
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.values = OrderedDict()
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, ids):
+        value = self.values.get(ids)
+        if value is not None:
+            self.values.move_to_end(ids)
+        return value
+
+    def put(self, ids, value):
+        self.values[ids] = value
+        self.values.move_to_end(ids)
+        if len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+
+class ChainState(object):
+    '''
+    Current antecedent list of a chain together with its log posterior
+
+    capture - CaptureState of the list, None while the log posterior came from the memo and the list was not accepted yet
+    parent, position - state this one was proposed from and the first position where they differ, used to fill in capture
+    '''
+    def __init__(self, d, ids, log_posterior, size_counts, capture, parent=None, position=0):
+        self.d = d
+        self.ids = ids
+        self.log_posterior = log_posterior
+        self.size_counts = size_counts
+        self.capture = capture
+        self.parent = parent
+        self.position = position
+
+# Memo entries kept by a PosteriorModel
+POSTERIOR_MEMO_SIZE = 100000
+
+# PosteriorModels shared per AntecedentGroup, see PosteriorModel.for_data
+posterior_models = weakref.WeakKeyDictionary()
+
+class PosteriorModel(object):
+    '''
+    log p(d|x,y,A,alpha,lmda,eta) for fixed data and hyperparameters. Combines the LikelihoodModel and PriorCache
+    and remembers the log posterior of recently scored lists, so the sampler, the convergence diagnostics and
+    point selection score each distinct list once.
+    '''
+    def __init__(self, likelihood, prior_cache, memo_size=POSTERIOR_MEMO_SIZE):
+        self.likelihood = likelihood
+        self.prior_cache = prior_cache
+        self.memo = PosteriorMemo(memo_size)
+
+    @classmethod
+    def for_data(cls, x, y, a, alpha, lmda, eta):
+        '''
+        PosteriorModel of the given data and hyperparameters, shared by every caller passing the same x, y and a
+        '''
+        models = posterior_models.setdefault(a, {})
+        key = (id(x), id(y), tuple(alpha), lmda, eta)
+        model = models.get(key)
+        if model is None or model.x is not x or model.y is not y:
+            model = cls(LikelihoodModel.for_data(x, y, a, alpha), PriorCache.from_group(a, lmda, eta))
+            model.x = x
+            model.y = y
+            models[key] = model
+        return model
+
+    def score(self, d):
+        ids = d.get_ids()
+        log_posterior = self.memo.get(ids)
+        if log_posterior is None:
+            log_posterior = self.prior_cache.log_prior(ids) + self.likelihood.create_state(ids).log_likelihood()
+            self.memo.put(ids, log_posterior)
+        return log_posterior
+
+    def create_chain_state(self, d):
+        ids = d.get_ids()
+        capture = self.likelihood.create_state(ids)
+        size_counts = self.prior_cache.size_counts(ids)
+        log_posterior = self.prior_cache.log_prior_from_counts(len(ids), size_counts) + capture.log_likelihood()
+        self.memo.put(ids, log_posterior)
+        return ChainState(d, ids, log_posterior, size_counts, capture)
+
+    def propose(self, state, proposed_d):
+        '''
+        ChainState of proposed_d, a single add/remove/move away from state. Only the rows reaching the first
+        changed antecedent are recounted, and not even those if the list is in the memo.
+        '''
+        ids = proposed_d.get_ids()
+        position = first_difference(state.ids, ids)
+        size_counts = self.prior_cache.proposal_size_counts(state.ids, ids, position, state.size_counts)
+
+        capture = None
+        log_posterior = self.memo.get(ids)
+        if log_posterior is None:
+            capture = self.likelihood.update_state(state.capture, ids, position)
+            log_posterior = self.prior_cache.log_prior_from_counts(len(ids), size_counts) + capture.log_likelihood()
+            self.memo.put(ids, log_posterior)
+
+        return ChainState(proposed_d, ids, log_posterior, size_counts, capture, state, position)
+
+    def propose_batch(self, state, proposed_ds):
+        '''
+        ChainStates of several lists proposed from state, the ones missing from the memo are scored together
+        with LikelihoodModel.score_batch
+        '''
+        proposed_states = []
+        unscored = []
+        for proposed_d in proposed_ds:
+            ids = proposed_d.get_ids()
+            position = first_difference(state.ids, ids)
+            size_counts = self.prior_cache.proposal_size_counts(state.ids, ids, position, state.size_counts)
+            proposed_state = ChainState(proposed_d, ids, self.memo.get(ids), size_counts, None, state, position)
+            if proposed_state.log_posterior is None:
+                unscored.append(proposed_state)
+            proposed_states.append(proposed_state)
+
+        if unscored:
+            log_likelihoods = self.likelihood.score_batch(state.capture, [proposed_state.ids for proposed_state in unscored], [proposed_state.position for proposed_state in unscored])
+            for proposed_state, log_likelihood in zip(unscored, log_likelihoods):
+                proposed_state.log_posterior = self.prior_cache.log_prior_from_counts(len(proposed_state.ids), proposed_state.size_counts) + log_likelihood
+                self.memo.put(proposed_state.ids, proposed_state.log_posterior)
+
+        return proposed_states
+
+    def accept(self, state):
+        '''
+        Make a proposed state ready to be the current one
+        '''
+        if state.capture is None:
+            state.capture = self.likelihood.update_state(state.parent.capture, state.ids, state.position)
+        state.parent = None
+        return state
+
+def logsumexp(values):
+    largest = max(values)
+    return largest + math.log(math.fsum(math.exp(value - largest) for value in values))
+
 # p(d|x,y,a,alpha,lmda,eta)
 def p_d_given_data(d, x, y, a, alpha, lmda, eta):
     """
@@ -171,4 +513,16 @@ def p_d_given_data(d, x, y, a, alpha, lmda, eta):
 
     alpha: hyperparameter for Dirichlet prior
     """
-    return p_d(d, a, lmda, eta) + p_y(y, x, d, alpha)
+    coverage = coverage_for_data(a, x)
+    if coverage is None:
+        x = encode_rows(x, getattr(a, "item_dictionary", None))
+    return p_d(d, a, lmda, eta) + p_y(y, x, d, alpha, coverage)
+
+def coverage_for_data(a, x):
+    '''
+    The coverage index of a if it was built over exactly the rows of x, raw or encoded, otherwise None
+    '''
+    coverage = getattr(a, "coverage", None)
+    if coverage is not None and coverage.built_over(x, getattr(a, "item_dictionary", None)):
+        return coverage
+    return None
@@ -1,8 +1,15 @@
+from array import array
 import copy
 import random
+import time
+import numpy as np
 
 from .utils import *
 from .generative_model import *
+from .diagnostics import *
+from .samples import *
+from .checkpoint import *
+from .warm_start import *
 
 MOVE_TYPE = 0
 REMOVE_TYPE = 1
@@ -10,127 +17,326 @@ ADD_TYPE = 2
 
 NUM_CHAINS = 3
 
-def generate_move_proposal(current_d):
-    proposed_d = copy.deepcopy(current_d)
+# Iterations run between convergence checks, which are also when the parallel sampler's workers synchronize
+CHECKPOINT_INTERVAL = 500
 
+# Convergence checks between saves of a run's checkpoint file
+CHECKPOINT_EVERY = 10
+
+# Reasons a sampler run stopped, see PosteriorSamples.status
+CONVERGED = "converged"
+EXTENDED = "extended"
+MAX_ITERATIONS = "max_iterations"
+MAX_SECONDS = "max_seconds"
+CANCELLED = "cancelled"
+
+def generate_move_proposal(current_d, rng=random):
     i, j = -1, -1
     while i == j:
-        i = random.randint(0, proposed_d.length() - 1)
-        j = random.randint(0, proposed_d.length() - 1)
+        i = rng.randint(0, current_d.length() - 1)
+        j = rng.randint(0, current_d.length() - 1)
 
-    proposed_d.move_antecedents(i, j)
+    proposed_d = current_d.moved(i, j)
 
     return proposed_d, 1.0
 
-def generate_remove_proposal(current_d, all_antecedents):
-    proposed_d = copy.deepcopy(current_d)
-
-    proposed_d.remove_antecedent(random.randint(0, proposed_d.length() - 1))
+def generate_remove_proposal(current_d, all_antecedents, rng=random):
+    proposed_d = current_d.removed(rng.randint(0, current_d.length() - 1))
 
     prob_backward = 1.0 / ((all_antecedents.length() - proposed_d.length()) * current_d.length())
     prob_forward = 1.0 / current_d.length()
 
     return proposed_d, prob_backward / prob_forward
 
-def generate_add_proposal(current_d, all_antecedents):
+def generate_add_proposal(current_d, all_antecedents, rng=random, pool=None):
     '''
     all_antecedents - AntecedentGroup
-    current_d - current list, AntecedentList
+    current_d - current list, RuleList
+    pool - AntecedentPool excluding current_d to draw the new antecedent from in O(1), without one
+    antecedents are drawn from all_antecedents until one is not in current_d
     '''
-    proposed_d = copy.deepcopy(current_d)
+    if pool is not None:
+        antecedent_id = pool.sample(rng)
+    else:
+        antecedent_id = all_antecedents.get_random_antecedent_id(rng)
+        while current_d.contains_id(antecedent_id):
+            antecedent_id = all_antecedents.get_random_antecedent_id(rng)
 
-    antecedent = all_antecedents.get_random_antecedent()
-    while proposed_d.contains(antecedent):
-        antecedent = all_antecedents.get_random_antecedent()
-
-    proposed_d.add_antecedent(random.randint(0, proposed_d.length()), antecedent)
+    proposed_d = current_d.added(rng.randint(0, current_d.length()), antecedent_id)
 
     prob_backward = 1.0 / proposed_d.length()
     prob_forward = 1.0 / ((all_antecedents.length() - current_d.length()) * proposed_d.length())
     return proposed_d, prob_backward / prob_forward
 
-def generate_proposal(current_d, all_antecedents):
+def generate_proposal(current_d, all_antecedents, rng=random, pool=None):
     while True:
-        proposal_type = random.randint(0, 2)
+        proposal_type = rng.randint(0, 2)
         if proposal_type == MOVE_TYPE:
             if current_d.length() == 1:
                 continue
-            return generate_move_proposal(current_d)
+            return generate_move_proposal(current_d, rng)
         if proposal_type == REMOVE_TYPE:
             if current_d.length() == 1:
                 continue
-            return generate_remove_proposal(current_d, all_antecedents)
+            return generate_remove_proposal(current_d, all_antecedents, rng)
         if proposal_type == ADD_TYPE:
             if current_d.length() == all_antecedents.length():
                 continue
-            return generate_add_proposal(current_d, all_antecedents)
+            return generate_add_proposal(current_d, all_antecedents, rng, pool)
 
-def check_accepted(proposed_d, current_d, all_antecedents, x, y, move_ratio, alpha, lmda, eta):
-    threshold = min(1.0, (move_ratio * math.exp(p_d_given_data(proposed_d, x, y, all_antecedents, alpha, lmda, eta)) /
-        math.exp(p_d_given_data(current_d, x, y, all_antecedents, alpha, lmda, eta))))
-    return random.random() < threshold
+def check_accepted(proposed_state, current_state, move_ratio, rng=random, inverse_temperature=1.0):
+    '''
+    Metropolis-Hastings acceptance done in log space, so very small or large posteriors cannot overflow
 
-def check_gelman_rubin(chains, means, variances, threshold, x, y, all_antecedents, alpha, lmda, eta):
-    samples = len(chains[0])
-    if samples < 2:
+    inverse_temperature - power the posterior is raised to, below 1 flattens it for tempered chains
+    '''
+    log_threshold = math.log(move_ratio) + inverse_temperature * (proposed_state.log_posterior - current_state.log_posterior)
+    u = rng.random()
+    return u == 0.0 or math.log(u) < log_threshold
+
+def check_converged(diagnostics, iterations, min_num_iterations, convergence_threshold, target_ess=None):
+    '''
+    Stop once the split R-hat is below convergence_threshold and either target_ess effective samples were
+    drawn or, without a target, min_num_iterations were run
+    '''
+    if not diagnostics.converged(convergence_threshold, target_ess):
         return False
+    return target_ess is not None or iterations >= min_num_iterations
+
+def chain_seeds(n_chains, seed=None):
+    '''
+    Seeds of n_chains independent random streams. Without a seed they are drawn from the random module,
+    so random.seed still makes runs repeatable.
+    '''
+    if seed is None:
+        seed = random.getrandbits(128)
+    return [int(sequence.generate_state(1, np.uint64)[0]) for sequence in np.random.SeedSequence(seed).spawn(n_chains)]
+
+class Chain(object):
+    '''
+    One Metropolis-Hastings chain over antecedent lists with its own random stream, and an AntecedentPool of
+    the antecedents not in its current list that follows every change of state
+    '''
+    def __init__(self, posterior, all_antecedents, lmda, eta, seed, d=None):
+        self.posterior = posterior
+        self.all_antecedents = all_antecedents
+        self.rng = random.Random(seed)
+        self.accepted = 0
+        self.inverse_temperature = 1.0
+        self.num_tries = 1
+        if d is None:
+            self.pool = AntecedentPool(all_antecedents)
+            d = generate_default_antecedent_list(all_antecedents, lmda, eta, posterior.prior_cache, self.rng, self.pool)
+        else:
+            self.pool = AntecedentPool(all_antecedents, d.get_ids())
+        self._state = posterior.create_chain_state(d)
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        # States also change outside step, e.g. when tempered chains exchange lists
+        self.pool.update(self._state.d, state.d)
+        self._state = state
+
+    @classmethod
+    def restore(cls, posterior, all_antecedents, lmda, eta, snapshot):
+        chain = cls(posterior, all_antecedents, lmda, eta, None, RuleList(all_antecedents, snapshot.ids))
+        chain.rng.setstate(snapshot.rng_state)
+        chain.accepted = snapshot.accepted
+        # Snapshots saved before chains kept a pool have none, their chains go on with a freshly ordered one
+        if getattr(snapshot, "pool", None) is not None:
+            chain.pool = copy.deepcopy(snapshot.pool)
+        return chain
 
-    for i in range(NUM_CHAINS):
-        val = p_d_given_data(chains[i][samples - 1], x, y, all_antecedents, alpha, lmda, eta)
-        updated_mean = ((samples - 1) * means[i] + val) / samples
-        updated_variance = ((samples - 2) * variances[i] + (val - updated_mean) * (val - means[i])) / (samples - 1)
-        means[i] = updated_mean
-        variances[i] = updated_variance
+    def snapshot(self):
+        return ChainSnapshot(self.state.ids, self.rng.getstate(), self.accepted, copy.deepcopy(self.pool))
 
-    w = 0
-    for i in range(NUM_CHAINS):
-        w += variances[i]
-    w /= NUM_CHAINS
+    def step(self):
+        if self.num_tries > 1:
+            return self.multiple_try_step()
 
-    mean_of_means = sum(means) / NUM_CHAINS
-    b = 0
-    for i in range(NUM_CHAINS):
-        b += pow(mean_of_means - means[i], 2)
-    b *= samples / (NUM_CHAINS - 1)
+        proposed_d, proposal_prob_ratio = generate_proposal(self.state.d, self.all_antecedents, self.rng, self.pool)
+        proposed_state = self.posterior.propose(self.state, proposed_d)
 
-    v = ((samples - 1) * w + (NUM_CHAINS + 1) * b / NUM_CHAINS) / samples
+        if check_accepted(proposed_state, self.state, proposal_prob_ratio, self.rng, self.inverse_temperature):
+            self.state = self.posterior.accept(proposed_state)
+            self.accepted += 1
+        return self.state
 
-    psrf = v / w
-    # print(psrf)
+    def multiple_try_log_weights(self, proposed_states, proposal_prob_ratios):
+        # w(y, x) = pi(y) * sqrt(T(y, x) / T(x, y)), the symmetric choice lambda(x, y) = 1 / sqrt(T(x, y) * T(y, x))
+        return [self.inverse_temperature * proposed_state.log_posterior + 0.5 * math.log(ratio) for proposed_state, ratio in zip(proposed_states, proposal_prob_ratios)]
 
-    return psrf < threshold
+    def multiple_try_step(self):
+        '''
+        Multiple-try Metropolis (Liu, Liang and Wong 2000): draws num_tries proposals, scored in one batch, picks
+        one in proportion to its weight, and accepts it against num_tries - 1 reference proposals drawn from it
+        plus the current list
+        '''
+        proposals = [generate_proposal(self.state.d, self.all_antecedents, self.rng, self.pool) for k in range(self.num_tries)]
+        proposed_states = self.posterior.propose_batch(self.state, [proposed_d for proposed_d, ratio in proposals])
+        log_weights = self.multiple_try_log_weights(proposed_states, [ratio for proposed_d, ratio in proposals])
 
-def brl_metropolis_hastings(min_num_iterations, burn_in, convergence_threshold, x, y, all_antecedents, alpha, lmda, eta):
+        largest = max(log_weights)
+        weights = [math.exp(log_weight - largest) for log_weight in log_weights]
+        u = self.rng.random() * math.fsum(weights)
+        selected = len(weights) - 1
+        cumulative = 0.0
+        for k, weight in enumerate(weights):
+            cumulative += weight
+            if u < cumulative:
+                selected = k
+                break
+
+        # The references are proposed from the selected list, which needs its capture state for that
+        selected_state = self.posterior.accept(proposed_states[selected])
+        self.pool.update(self.state.d, selected_state.d)
+        references = [generate_proposal(selected_state.d, self.all_antecedents, self.rng, self.pool) for k in range(self.num_tries - 1)]
+        self.pool.update(selected_state.d, self.state.d)
+        reference_states = self.posterior.propose_batch(selected_state, [reference_d for reference_d, ratio in references]) + [self.state]
+        # Going back to the current list has the inverse proposal ratio of reaching the selected one
+        reference_log_weights = self.multiple_try_log_weights(reference_states, [ratio for reference_d, ratio in references] + [1.0 / proposals[selected][1]])
+
+        log_threshold = logsumexp(log_weights) - logsumexp(reference_log_weights)
+        u = self.rng.random()
+        if u == 0.0 or math.log(u) < log_threshold:
+            self.state = selected_state
+            self.accepted += 1
+        return self.state
+
+def check_finished(diagnostics, iterations, min_num_iterations, convergence_threshold, target_ess, stop_iteration):
+    '''
+    Status a run stops with at this convergence check, None to keep going. Runs with a stop_iteration run until it
+    instead of stopping on convergence.
+    '''
+    if stop_iteration is not None:
+        return EXTENDED if iterations >= stop_iteration else None
+    if check_converged(diagnostics, iterations, min_num_iterations, convergence_threshold, target_ess):
+        return CONVERGED
+    return None
+
+def check_budget(iterations, start_time, max_iterations, max_seconds, should_stop, diagnostics):
+    '''
+    Status a run stops with because it used up its budget or was cancelled, None to keep going
+    '''
+    if max_iterations is not None and iterations >= max_iterations:
+        return MAX_ITERATIONS
+    if max_seconds is not None and time.monotonic() - start_time >= max_seconds:
+        return MAX_SECONDS
+    if should_stop is not None and should_stop(iterations, diagnostics):
+        return CANCELLED
+    return None
+
+def checkpoint_due(iterations, checkpoint_interval, checkpoint_every):
+    return (iterations // checkpoint_interval) % checkpoint_every == 0
+
+def brl_metropolis_hastings(min_num_iterations, burn_in, convergence_threshold, x, y, all_antecedents, alpha, lmda, eta, n_chains=NUM_CHAINS, n_jobs=1, seed=None, checkpoint_interval=CHECKPOINT_INTERVAL, target_ess=None, thin=1, spill_dir=None, checkpoint_path=None, checkpoint_every=CHECKPOINT_EVERY, resume_from=None, extra_iterations=None, num_tries=1, max_iterations=None, max_seconds=None, should_stop=None, init=PRIOR_INIT):
     '''
     all_antecedents - AntecedentGroup
-    min_num_iterations - minimum number of iterations to run the chains for
+    min_num_iterations - minimum number of iterations to run the chains for, unused if target_ess is given
     burn_in - amount of time to let the chain burn in
+    convergence_threshold - split R-hat of the chains' log posteriors needed to stop
+    n_chains - number of chains, convergence is checked across all of them
+    n_jobs - number of worker processes running the chains, -1 uses every core. Results only depend on seed, not n_jobs.
+    seed - seed of the chains' random streams
+    checkpoint_interval - iterations run between convergence checks
+    target_ess - stop once the bulk and tail effective sample sizes reach it, instead of after min_num_iterations
+    thin, spill_dir - see SampleStore
+    checkpoint_path - file the run is saved to every checkpoint_every convergence checks and when it stops,
+        with spill_dir the checkpoint refers to the spill files instead of holding their samples
+    resume_from - checkpoint file to continue from, the run then goes on exactly as if it had not been interrupted.
+        n_chains and seed are taken from the checkpoint, the other arguments must match the saved run. A run that
+        had converged or run its extra iterations is returned as saved unless extra_iterations is given.
+    extra_iterations - run this many more iterations (rounded up to checkpoint_interval) instead of stopping on
+        convergence, to extend a finished run
+    num_tries - proposals drawn and scored together per iteration, above 1 the chains use multiple-try Metropolis
+    max_iterations - stop after this many iterations in total, including burn in and iterations before resuming
+    max_seconds - stop after running this long
+    should_stop - callable taking the iterations run and the latest Diagnostics (None before the first check),
+        the run stops once it returns True. Called every iteration, or every checkpoint_interval iterations when n_jobs != 1.
+    init - how the chains start, from lists drawn from the prior, greedy or beam searched warm starts, or given
+        lists, see initial_lists. Warm starts need a far shorter burn_in. Ignored when resuming.
+
+    Returns the PosteriorSamples of every chain after burn in, whose status says why the run stopped and
+    converged whether the last diagnostics passed the convergence criteria
     '''
-    current_ds = []
-    all_ds = []
-    means = []
-    variances = []
-    for i in range(NUM_CHAINS):
-        current_ds.append(generate_default_antecedent_list(all_antecedents, lmda, eta))
-        all_ds.append([])
-        means.append(0)
-        variances.append(0)
+    settings = sampler_settings(all_antecedents, alpha, lmda, eta, burn_in, thin, num_tries, checkpoint_interval, min_num_iterations, convergence_threshold, target_ess)
+    checkpoint = None
+    if resume_from is not None:
+        checkpoint = load_checkpoint(resume_from)
+        checkpoint.check_settings(settings)
+        if checkpoint.finished and extra_iterations is None:
+            return checkpoint.samples
+        n_chains = checkpoint.num_chains()
+
+    # The last seed is the warm start search's, the chains' seeds do not depend on whether it is used
+    seeds = chain_seeds(n_chains + 1, seed)
+    init_seed = seeds.pop()
+
+    posterior = None
+    initial_ds = None
+    if checkpoint is None and not (isinstance(init, str) and init == PRIOR_INIT):
+        posterior = PosteriorModel.for_data(x, y, all_antecedents, alpha, lmda, eta)
+        initial_ds = initial_lists(init, posterior, all_antecedents, n_chains, init_seed)
 
-    i = 0
-    while not check_gelman_rubin(all_ds, means, variances, convergence_threshold, x, y, all_antecedents, alpha, lmda, eta) or i < min_num_iterations:
-        if i % 500 == 0:
-            print("Iteration: %d" % (i))
+    if n_jobs != 1:
+        from .parallel_mcmc import parallel_metropolis_hastings
+        return parallel_metropolis_hastings(min_num_iterations, burn_in, convergence_threshold, x, y, all_antecedents, alpha, lmda, eta, seeds, n_jobs, checkpoint_interval, target_ess, thin, spill_dir, checkpoint_path, checkpoint_every, checkpoint, extra_iterations, num_tries, max_iterations, max_seconds, should_stop, initial_ds)
 
-        for j in range(NUM_CHAINS):
-            proposed_d, proposal_prob_ratio = generate_proposal(current_ds[j], all_antecedents)
+    if posterior is None:
+        posterior = PosteriorModel.for_data(x, y, all_antecedents, alpha, lmda, eta)
 
-            if check_accepted(proposed_d, current_ds[j], all_antecedents, x, y, proposal_prob_ratio, alpha, lmda, eta):
-                current_ds[j] = proposed_d
+    if checkpoint is None:
+        chains = []
+        stores = []
+        traces = []
+        for j in range(n_chains):
+            chains.append(Chain(posterior, all_antecedents, lmda, eta, seeds[j], None if initial_ds is None else initial_ds[j]))
+            stores.append(SampleStore(thin, spill_dir))
+            traces.append(array("d"))
+        i = 0
+    else:
+        chains = [Chain.restore(posterior, all_antecedents, lmda, eta, snapshot) for snapshot in checkpoint.chains]
+        stores = checkpoint.samples.stores
+        traces = checkpoint.samples.traces
+        i = checkpoint.iterations
+
+    for chain in chains:
+        chain.num_tries = num_tries
+
+    stop_iteration = i + extra_iterations if extra_iterations is not None else None
+    start_time = time.monotonic()
+    diagnostics = None if checkpoint is None else checkpoint.samples.diagnostics
+    status = None
+    while status is None:
+        for j, chain in enumerate(chains):
+            state = chain.step()
 
             if i >= burn_in:
-                all_ds[j].append(current_ds[j])
+                stores[j].add(state.ids, state.log_posterior)
+                traces[j].append(state.log_posterior)
 
         i += 1
+        checked = i % checkpoint_interval == 0
+        if checked:
+            diagnostics = diagnose(traces, [chain.accepted / checkpoint_interval for chain in chains])
+            for chain in chains:
+                chain.accepted = 0
+            print("Iteration: %d %s" % (i, diagnostics.summary()))
+            status = check_finished(diagnostics, i, min_num_iterations, convergence_threshold, target_ess, stop_iteration)
+
+        if status is None:
+            status = check_budget(i, start_time, max_iterations, max_seconds, should_stop, diagnostics)
+            if status is not None and not checked:
+                # Stopped between checks, report on everything sampled so far
+                diagnostics = diagnose(traces, [chain.accepted / (i % checkpoint_interval) for chain in chains])
+
+        if checkpoint_path is not None and (status is not None or (checked and checkpoint_due(i, checkpoint_interval, checkpoint_every))):
+            save_checkpoint(checkpoint_path, SamplerCheckpoint(i, [chain.snapshot() for chain in chains], PosteriorSamples(stores, traces, diagnostics, i, status, diagnostics is not None and diagnostics.converged(convergence_threshold, target_ess)), status in (CONVERGED, EXTENDED), settings))
 
     print("Iterations Run:", i)
-    return all_ds[0]
+    print("Status:", status)
+    return PosteriorSamples(stores, traces, diagnostics, i, status, diagnostics is not None and diagnostics.converged(convergence_threshold, target_ess))
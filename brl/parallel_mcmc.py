@@ -0,0 +1,208 @@
+from array import array
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+from .utils import *
+from .generative_model import *
+from .mcmc import *
+
+# Message asking a chain_worker for the ChainSnapshots of its chains
+SNAPSHOT_MESSAGE = "snapshot"
+
+def share_array(array, blocks):
+    '''
+    Copy array into a new shared memory block, appended to blocks, and return what workers need to attach to it
+    '''
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return (block.name, array.shape, array.dtype.str)
+
+def attach_array(descriptor, blocks):
+    '''
+    Read-only view of an array shared with share_array, the block is appended to blocks to keep it open
+    '''
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+def chain_worker(connection, all_antecedents, coverage_descriptor, num_samples, labels_descriptor, alpha, lmda, eta, seeds, snapshots=None, num_tries=1, initial_ids=None):
+    '''
+    Runs the chains with the given seeds, starting from the lists initial_ids if given, or restored from the
+    given ChainSnapshots, in lockstep until told to stop. Each message is either the (first iteration, number
+    of iterations, burn in, whether a convergence check follows) to run, answered per chain with the log
+    posteriors after burn in, the (ids, count, log posterior) runs of the lists sampled after burn in and the
+    number of proposals accepted since the last check, or SNAPSHOT_MESSAGE, answered with every chain's
+    ChainSnapshot.
+    '''
+    blocks = []
+    try:
+        coverage = CoverageIndex(attach_array(coverage_descriptor, blocks), num_samples)
+        likelihood = LikelihoodModel(coverage, attach_array(labels_descriptor, blocks), alpha)
+        posterior = PosteriorModel(likelihood, PriorCache.from_group(all_antecedents, lmda, eta))
+        if snapshots is None and initial_ids is None:
+            chains = [Chain(posterior, all_antecedents, lmda, eta, seed) for seed in seeds]
+        elif snapshots is None:
+            chains = [Chain(posterior, all_antecedents, lmda, eta, seed, RuleList(all_antecedents, ids)) for seed, ids in zip(seeds, initial_ids)]
+        else:
+            chains = [Chain.restore(posterior, all_antecedents, lmda, eta, snapshot) for snapshot in snapshots]
+        for chain in chains:
+            chain.num_tries = num_tries
+
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            if message == SNAPSHOT_MESSAGE:
+                connection.send([chain.snapshot() for chain in chains])
+                continue
+            start, num_iterations, burn_in, checked = message
+
+            traces = [[] for chain in chains]
+            samples = [[] for chain in chains]
+            for i in range(start, start + num_iterations):
+                for j, chain in enumerate(chains):
+                    state = chain.step()
+                    if i >= burn_in:
+                        traces[j].append(state.log_posterior)
+                        # Unchanged states keep their ids tuple, so runs are found by identity
+                        if samples[j] and samples[j][-1][0] is state.ids:
+                            samples[j][-1][1] += 1
+                        else:
+                            samples[j].append([state.ids, 1, state.log_posterior])
+
+            accepted = [chain.accepted for chain in chains]
+            if checked:
+                for chain in chains:
+                    chain.accepted = 0
+            connection.send((traces, samples, accepted))
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+        for block in blocks:
+            block.close()
+
+def shareable_coverage(x, all_antecedents):
+    coverage = coverage_for_data(all_antecedents, x)
+    # Lazy indexes exist to bound memory per process, a dense one shared by every worker replaces it
+    if coverage is None or isinstance(coverage, LazyCoverageIndex):
+        coverage = CoverageIndex.from_antecedents(all_antecedents.antecedents, encode_rows(x, all_antecedents.item_dictionary))
+    return coverage
+
+def receive(connection):
+    result = connection.recv()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def parallel_metropolis_hastings(min_num_iterations, burn_in, convergence_threshold, x, y, all_antecedents, alpha, lmda, eta, seeds, n_jobs, checkpoint_interval=CHECKPOINT_INTERVAL, target_ess=None, thin=1, spill_dir=None, checkpoint_path=None, checkpoint_every=CHECKPOINT_EVERY, checkpoint=None, extra_iterations=None, num_tries=1, max_iterations=None, max_seconds=None, should_stop=None, initial_ds=None):
+    '''
+    brl_metropolis_hastings with the chains spread over n_jobs worker processes. The coverage index and labels
+    are placed in shared memory instead of being pickled to every worker, and the workers only synchronize
+    at the convergence checks every checkpoint_interval iterations, so the samples match a serial run with
+    the same seeds. max_seconds and should_stop are only checked then too, while max_iterations shortens
+    the last batch of iterations to stop at the same iteration as a serial run.
+
+    seeds - seed of each chain, see chain_seeds
+    checkpoint - SamplerCheckpoint to continue from, None to start new chains
+    initial_ds - starting RuleList of every new chain, None to draw them from the prior
+    '''
+    n_chains = len(seeds)
+    settings = sampler_settings(all_antecedents, alpha, lmda, eta, burn_in, thin, num_tries, checkpoint_interval, min_num_iterations, convergence_threshold, target_ess)
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, n_chains)
+
+    coverage = shareable_coverage(x, all_antecedents)
+    # Workers score through their shared coverage index, the group itself is sent without one
+    worker_antecedents = AntecedentGroup(all_antecedents.antecedents, None, all_antecedents.item_dictionary)
+
+    blocks = []
+    workers = []
+    try:
+        coverage_descriptor = share_array(coverage.bitsets, blocks)
+        labels_descriptor = share_array(np.asarray(y), blocks)
+
+        # Chain j runs on worker j % n_jobs
+        for k in range(n_jobs):
+            parent_connection, child_connection = multiprocessing.Pipe()
+            snapshots = None if checkpoint is None else checkpoint.chains[k::n_jobs]
+            # Lists are sent as their ids, the workers rebuild them over their own group
+            initial_ids = None if initial_ds is None else [d.get_ids() for d in initial_ds[k::n_jobs]]
+            process = multiprocessing.Process(target=chain_worker, args=(child_connection, worker_antecedents, coverage_descriptor, coverage.num_samples, labels_descriptor, alpha, lmda, eta, seeds[k::n_jobs], snapshots, num_tries, initial_ids))
+            process.start()
+            child_connection.close()
+            workers.append((process, parent_connection))
+
+        if checkpoint is None:
+            stores = [SampleStore(thin, spill_dir) for j in range(n_chains)]
+            traces = [array("d") for j in range(n_chains)]
+            i = 0
+        else:
+            stores = checkpoint.samples.stores
+            traces = checkpoint.samples.traces
+            i = checkpoint.iterations
+
+        stop_iteration = i + extra_iterations if extra_iterations is not None else None
+        start_time = time.monotonic()
+        diagnostics = None if checkpoint is None else checkpoint.samples.diagnostics
+        status = None
+        while status is None:
+            # Run up to the next convergence check, or to max_iterations if that comes first
+            num_iterations = checkpoint_interval - i % checkpoint_interval
+            if max_iterations is not None:
+                num_iterations = max(min(num_iterations, max_iterations - i), 1)
+            checked = (i + num_iterations) % checkpoint_interval == 0
+            for process, connection in workers:
+                connection.send((i, num_iterations, burn_in, checked))
+
+            accepted_counts = [None] * n_chains
+            for k, (process, connection) in enumerate(workers):
+                for j, trace, runs, accepted in zip(range(k, n_chains, n_jobs), *receive(connection)):
+                    traces[j].extend(trace)
+                    for ids, count, log_posterior in runs:
+                        stores[j].add(ids, log_posterior, count)
+                    accepted_counts[j] = accepted
+
+            i += num_iterations
+            if checked:
+                diagnostics = diagnose(traces, [accepted / checkpoint_interval for accepted in accepted_counts])
+                print("Iteration: %d %s" % (i, diagnostics.summary()))
+                status = check_finished(diagnostics, i, min_num_iterations, convergence_threshold, target_ess, stop_iteration)
+
+            if status is None:
+                status = check_budget(i, start_time, max_iterations, max_seconds, should_stop, diagnostics)
+                if status is not None and not checked:
+                    diagnostics = diagnose(traces, [accepted / (i % checkpoint_interval) for accepted in accepted_counts])
+
+            if checkpoint_path is not None and (status is not None or (checked and checkpoint_due(i, checkpoint_interval, checkpoint_every))):
+                snapshots = [None] * n_chains
+                for process, connection in workers:
+                    connection.send(SNAPSHOT_MESSAGE)
+                for k, (process, connection) in enumerate(workers):
+                    snapshots[k::n_jobs] = receive(connection)
+                save_checkpoint(checkpoint_path, SamplerCheckpoint(i, snapshots, PosteriorSamples(stores, traces, diagnostics, i, status, diagnostics is not None and diagnostics.converged(convergence_threshold, target_ess)), status in (CONVERGED, EXTENDED), settings))
+
+        for process, connection in workers:
+            connection.send(None)
+        for process, connection in workers:
+            process.join()
+    finally:
+        for process, connection in workers:
+            if process.is_alive():
+                process.terminate()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    print("Iterations Run:", i)
+    print("Status:", status)
+    return PosteriorSamples(stores, traces, diagnostics, i, status, diagnostics is not None and diagnostics.converged(convergence_threshold, target_ess))
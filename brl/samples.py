@@ -0,0 +1,298 @@
+from array import array
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+from .utils import *
+
+# Antecedent ids a spilling SampleStore buffers in memory before appending them to its files
+MAX_BUFFERED_IDS = 1 << 16
+
+# Bytes read at a time when an unpickled SpillArray copies its spill file
+SPILL_COPY_BYTES = 1 << 20
+
+class SpillArray(object):
+    '''
+    Append-only array buffered in an array.array that can spill its contents to a file, read back through a memmap
+    '''
+    def __init__(self, typecode, spill_dir=None):
+        self.typecode = typecode
+        self.dtype = np.dtype(typecode)
+        self.spill_dir = spill_dir
+        self.buffer = array(typecode)
+        self.path = None
+        self.spilled = 0
+
+    def __len__(self):
+        return self.spilled + len(self.buffer)
+
+    def append(self, value):
+        self.buffer.append(value)
+
+    def extend(self, values):
+        self.buffer.extend(values)
+
+    def spill(self):
+        if len(self.buffer) == 0:
+            return
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(suffix=".samples", dir=self.spill_dir)
+            os.close(fd)
+        with open(self.path, "ab") as f:
+            self.buffer.tofile(f)
+        self.spilled += len(self.buffer)
+        self.buffer = array(self.typecode)
+
+    def view(self):
+        buffered = np.array(self.buffer, dtype=self.dtype)
+        if self.spilled == 0:
+            return buffered
+        spilled = np.memmap(self.path, dtype=self.dtype, mode="r", shape=(self.spilled,))
+        return spilled if len(buffered) == 0 else np.concatenate([spilled, buffered])
+
+    def nbytes(self):
+        return len(self.buffer) * self.buffer.itemsize
+
+    def __getstate__(self):
+        # Pickles only carry the buffered values, spilled ones stay in the spill file and are referred to by
+        # its path and their number, so saving a checkpoint does not grow with the samples spilled so far
+        state = self.__dict__.copy()
+        state["buffer"] = self.buffer.tobytes()
+        return state
+
+    def __setstate__(self, state):
+        values = state["buffer"]
+        self.__dict__.update(state)
+        self.buffer = array(self.typecode)
+        self.buffer.frombytes(values)
+        if self.spilled > 0:
+            self.copy_spilled(self.path)
+
+    def copy_spilled(self, source_path):
+        '''
+        Continue in a copy of the first spilled values of source_path. The pickled array may still be in use,
+        or have been resumed before, so its file can hold more values than were spilled when it was pickled.
+        '''
+        size = self.spilled * self.dtype.itemsize
+        if not os.path.exists(source_path) or os.path.getsize(source_path) < size:
+            raise ValueError("Spill file {} is missing or holds fewer than {} values".format(source_path, self.spilled))
+
+        fd, self.path = tempfile.mkstemp(suffix=".samples", dir=self.spill_dir)
+        with open(source_path, "rb") as source, os.fdopen(fd, "wb") as target:
+            while size > 0:
+                chunk = source.read(min(size, SPILL_COPY_BYTES))
+                target.write(chunk)
+                size -= len(chunk)
+
+    def close(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+        self.spilled = 0
+        self.buffer = array(self.typecode)
+
+class SampleStore(object):
+    '''
+    Posterior samples of one chain, run-length encoded: only the lists the chain moves to are kept, as
+    antecedent ids, with the number of samples it dwelled on each and its log posterior.
+
+    thin - keep every thin-th sample
+    spill_dir - directory to spill the runs to once MAX_BUFFERED_IDS ids are buffered, None keeps them in memory
+    '''
+    def __init__(self, thin=1, spill_dir=None, max_buffered_ids=MAX_BUFFERED_IDS):
+        self.thin = thin
+        self.spill_dir = spill_dir
+        self.max_buffered_ids = max_buffered_ids
+        self.iterations = 0 # samples added before thinning
+        self.num_samples = 0 # samples kept after thinning
+
+        self.ids = SpillArray("i", spill_dir)
+        self.lengths = SpillArray("i", spill_dir)
+        self.counts = SpillArray("q", spill_dir)
+        self.log_posteriors = SpillArray("d", spill_dir)
+
+        # Run still being extended, only written out once the chain moves on
+        self.current_ids = None
+        self.current_count = 0
+        self.current_log_posterior = None
+
+    def __len__(self):
+        return self.num_samples
+
+    def add(self, ids, log_posterior, count=1):
+        '''
+        Record that the chain spent count more iterations on the list ids
+        '''
+        kept = (self.iterations + count + self.thin - 1) // self.thin - (self.iterations + self.thin - 1) // self.thin
+        self.iterations += count
+        if kept == 0:
+            return
+        self.num_samples += kept
+
+        if self.current_ids is not None and (ids is self.current_ids or ids == self.current_ids):
+            self.current_count += kept
+            return
+
+        self.end_run()
+        self.current_ids = ids
+        self.current_count = kept
+        self.current_log_posterior = log_posterior
+
+    def end_run(self):
+        if self.current_ids is None:
+            return
+        self.ids.extend(self.current_ids)
+        self.lengths.append(len(self.current_ids))
+        self.counts.append(self.current_count)
+        self.log_posteriors.append(self.current_log_posterior)
+        self.current_ids = None
+        self.current_count = 0
+
+        if self.spill_dir is not None and len(self.ids.buffer) >= self.max_buffered_ids:
+            self.spill()
+
+    def spill(self):
+        for values in (self.ids, self.lengths, self.counts, self.log_posteriors):
+            values.spill()
+
+    def num_runs(self):
+        return len(self.lengths) + (self.current_ids is not None)
+
+    def run_arrays(self):
+        '''
+        (lengths, counts, log posteriors) of every run as arrays
+        '''
+        lengths, counts, log_posteriors = self.lengths.view(), self.counts.view(), self.log_posteriors.view()
+        if self.current_ids is not None:
+            lengths = np.append(lengths, len(self.current_ids))
+            counts = np.append(counts, self.current_count)
+            log_posteriors = np.append(log_posteriors, self.current_log_posterior)
+        return lengths, counts, log_posteriors
+
+    def runs(self):
+        '''
+        Iterates over the (ids, count, log posterior) of every run in order
+        '''
+        ids = self.ids.view()
+        lengths, counts, log_posteriors = self.lengths.view(), self.counts.view(), self.log_posteriors.view()
+        start = 0
+        for length, count, log_posterior in zip(lengths, counts, log_posteriors):
+            yield tuple(ids[start:start + length].tolist()), int(count), float(log_posterior)
+            start += length
+        if self.current_ids is not None:
+            yield self.current_ids, self.current_count, self.current_log_posterior
+
+    def rule_lists(self, all_antecedents):
+        '''
+        Iterates over the (RuleList, count) of every run
+        '''
+        for ids, count, log_posterior in self.runs():
+            yield RuleList(all_antecedents, ids), count
+
+    def expand(self, all_antecedents):
+        '''
+        One RuleList per sample, repeated samples share their RuleList
+        '''
+        lists = []
+        for rule_list, count in self.rule_lists(all_antecedents):
+            lists.extend([rule_list] * count)
+        return lists
+
+    def nbytes(self):
+        return sum(values.nbytes() for values in (self.ids, self.lengths, self.counts, self.log_posteriors))
+
+    def close(self):
+        '''
+        Remove any spill files, the store is empty afterwards
+        '''
+        for values in (self.ids, self.lengths, self.counts, self.log_posteriors):
+            values.close()
+        self.current_ids = None
+        self.current_count = 0
+        self.num_samples = 0
+        self.iterations = 0
+
+class PosteriorSamples(object):
+    '''
+    Samples of every chain of a sampler run. Keeps each chain's SampleStore and log posterior trace apart
+    for diagnostics, and merges them for point estimation and model averaging.
+
+    stores - SampleStore of every chain
+    traces - log posterior of every chain after every iteration past burn in, before thinning
+    diagnostics - Diagnostics of the last convergence check
+    iterations - iterations run, including burn in
+    status - why the run stopped: converged, extended (ran its extra iterations), max_iterations, max_seconds or cancelled
+    converged - whether the last diagnostics passed the run's convergence criteria
+    '''
+    def __init__(self, stores, traces, diagnostics=None, iterations=0, status=None, converged=False):
+        self.stores = stores
+        self.traces = traces
+        self.diagnostics = diagnostics
+        self.iterations = iterations
+        self.status = status
+        self.converged = converged
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores)
+
+    def num_chains(self):
+        return len(self.stores)
+
+    def chain(self, j):
+        return self.stores[j]
+
+    def chain_traces(self):
+        '''
+        (chains, draws) array of the log posterior traces
+        '''
+        return np.asarray(self.traces, dtype=float)
+
+    def runs(self):
+        '''
+        Iterates over the (ids, count, log posterior) runs of every chain, one chain after the other
+        '''
+        for store in self.stores:
+            for run in store.runs():
+                yield run
+
+    def merged_runs(self):
+        '''
+        (ids, count, log posterior) of every distinct list sampled by any chain, in order of first appearance,
+        with its samples summed over the chains
+        '''
+        merged = OrderedDict()
+        for ids, count, log_posterior in self.runs():
+            if ids in merged:
+                merged[ids][1] += count
+            else:
+                merged[ids] = [ids, count, log_posterior]
+        return [tuple(run) for run in merged.values()]
+
+    def rule_lists(self, all_antecedents):
+        '''
+        Iterates over the (RuleList, count) of every distinct list sampled by any chain
+        '''
+        for ids, count, log_posterior in self.merged_runs():
+            yield RuleList(all_antecedents, ids), count
+
+    def expand(self, all_antecedents):
+        lists = []
+        for store in self.stores:
+            lists.extend(store.expand(all_antecedents))
+        return lists
+
+    def nbytes(self):
+        return sum(store.nbytes() for store in self.stores) + sum(len(trace) * trace.itemsize for trace in self.traces)
+
+    def close(self):
+        for store in self.stores:
+            store.close()
+
+def weighted_samples(generated_mcmc_samples, all_antecedents):
+    '''
+    (antecedent list, number of samples) pairs of a SampleStore or PosteriorSamples, or of a plain list of sampled lists
+    '''
+    if isinstance(generated_mcmc_samples, (SampleStore, PosteriorSamples)):
+        return list(generated_mcmc_samples.rule_lists(all_antecedents))
+    return [(antecedent_list, 1) for antecedent_list in generated_mcmc_samples]
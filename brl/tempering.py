@@ -0,0 +1,158 @@
+from array import array
+import math
+import random
+import time
+
+from .utils import *
+from .generative_model import *
+from .mcmc import *
+
+NUM_TEMPERATURES = 4
+
+# Temperature of the hottest chain of a ladder, and the temperature annealing starts from
+MAX_TEMPERATURE = 10.0
+
+# Temperature annealing ends at, below 1 so the search settles into the best mode it found
+MIN_ANNEALING_TEMPERATURE = 0.1
+
+def temperature_ladder(num_temperatures, max_temperature):
+    '''
+    Geometrically spaced temperatures from 1, the posterior itself, to max_temperature
+    '''
+    if num_temperatures == 1:
+        return [1.0]
+    return [max_temperature ** (k / (num_temperatures - 1)) for k in range(num_temperatures)]
+
+class TemperatureLadder(object):
+    '''
+    Chains targeting p(d|x,y,A,alpha,lmda,eta)^(1/T) for every temperature T of a ladder, the first one at T = 1.
+    Neighbouring chains propose to exchange their lists, so the cold chain can leave a local mode through the
+    hotter chains, which move between modes more freely.
+
+    d - list every chain starts from, None draws each chain's from the prior
+    '''
+    def __init__(self, posterior, all_antecedents, lmda, eta, temperatures, seeds, swap_seed, d=None):
+        self.chains = []
+        for temperature, seed in zip(temperatures, seeds):
+            chain = Chain(posterior, all_antecedents, lmda, eta, seed, d)
+            chain.inverse_temperature = 1.0 / temperature
+            self.chains.append(chain)
+
+        self.rng = random.Random(swap_seed)
+        self.swaps_proposed = [0] * (len(self.chains) - 1)
+        self.swaps_accepted = [0] * (len(self.chains) - 1)
+        self.swap_parity = 0
+
+    def cold_chain(self):
+        return self.chains[0]
+
+    def step(self):
+        for chain in self.chains:
+            chain.step()
+
+    def swap(self):
+        '''
+        Propose exchanging the lists of every other pair of neighbouring chains, alternating between the even and odd pairs
+        '''
+        for k in range(self.swap_parity, len(self.chains) - 1, 2):
+            colder, hotter = self.chains[k], self.chains[k + 1]
+            log_ratio = (colder.inverse_temperature - hotter.inverse_temperature) * (hotter.state.log_posterior - colder.state.log_posterior)
+
+            self.swaps_proposed[k] += 1
+            u = self.rng.random()
+            if u == 0.0 or math.log(u) < log_ratio:
+                colder.state, hotter.state = hotter.state, colder.state
+                self.swaps_accepted[k] += 1
+        self.swap_parity = 1 - self.swap_parity
+
+    def swap_acceptance_rates(self):
+        '''
+        Fraction of the proposed exchanges accepted between each pair of neighbouring temperatures
+        '''
+        return [accepted / proposed if proposed > 0 else math.nan for accepted, proposed in zip(self.swaps_accepted, self.swaps_proposed)]
+
+def brl_parallel_tempering(min_num_iterations, burn_in, convergence_threshold, x, y, all_antecedents, alpha, lmda, eta, n_chains=NUM_CHAINS, num_temperatures=NUM_TEMPERATURES, max_temperature=MAX_TEMPERATURE, swap_interval=1, seed=None, checkpoint_interval=CHECKPOINT_INTERVAL, target_ess=None, thin=1, spill_dir=None, max_iterations=None, max_seconds=None, should_stop=None, init=PRIOR_INIT):
+    '''
+    Tempered counterpart of brl_metropolis_hastings. Each of the n_chains chains is the cold chain of its own
+    TemperatureLadder of num_temperatures chains, and only cold chains are sampled and checked for convergence.
+
+    swap_interval - iterations between proposed exchanges along each ladder
+    max_iterations, max_seconds, should_stop - stop early as in brl_metropolis_hastings
+    init - how each ladder starts as in brl_metropolis_hastings, all chains of a ladder start from the same list
+
+    Returns the PosteriorSamples of the cold chains, with the swap acceptance rates of every ladder
+    between neighbouring temperatures in swap_acceptance_rates
+    '''
+    posterior = PosteriorModel.for_data(x, y, all_antecedents, alpha, lmda, eta)
+    temperatures = temperature_ladder(num_temperatures, max_temperature)
+
+    # Every chain of every ladder has its own random stream, and so do every ladder's swapping and the warm start search
+    seeds = chain_seeds(n_chains * (num_temperatures + 1) + 1, seed)
+    initial_ds = initial_lists(init, posterior, all_antecedents, n_chains, seeds.pop())
+    ladders = []
+    stores = []
+    traces = []
+    for j in range(n_chains):
+        ladder_seeds = seeds[j * (num_temperatures + 1):(j + 1) * (num_temperatures + 1)]
+        ladders.append(TemperatureLadder(posterior, all_antecedents, lmda, eta, temperatures, ladder_seeds[:-1], ladder_seeds[-1], None if initial_ds is None else initial_ds[j]))
+        stores.append(SampleStore(thin, spill_dir))
+        traces.append(array("d"))
+
+    i = 0
+    start_time = time.monotonic()
+    diagnostics = None
+    status = None
+    while status is None:
+        for j, ladder in enumerate(ladders):
+            ladder.step()
+            if (i + 1) % swap_interval == 0:
+                ladder.swap()
+
+            if i >= burn_in:
+                state = ladder.cold_chain().state
+                stores[j].add(state.ids, state.log_posterior)
+                traces[j].append(state.log_posterior)
+
+        i += 1
+        checked = i % checkpoint_interval == 0
+        if checked:
+            diagnostics = diagnose(traces, [ladder.cold_chain().accepted / checkpoint_interval for ladder in ladders])
+            for ladder in ladders:
+                for chain in ladder.chains:
+                    chain.accepted = 0
+            print("Iteration: %d %s" % (i, diagnostics.summary()))
+            print("Swap Acceptance:", " ".join("%.3f" % rate for rate in ladders[0].swap_acceptance_rates()))
+
+            status = check_finished(diagnostics, i, min_num_iterations, convergence_threshold, target_ess, None)
+
+        if status is None:
+            status = check_budget(i, start_time, max_iterations, max_seconds, should_stop, diagnostics)
+            if status is not None and not checked:
+                diagnostics = diagnose(traces, [ladder.cold_chain().accepted / (i % checkpoint_interval) for ladder in ladders])
+
+    print("Iterations Run:", i)
+    print("Status:", status)
+    samples = PosteriorSamples(stores, traces, diagnostics, i, status, diagnostics.converged(convergence_threshold, target_ess))
+    samples.swap_acceptance_rates = [ladder.swap_acceptance_rates() for ladder in ladders]
+    return samples
+
+def brl_simulated_annealing(num_iterations, x, y, all_antecedents, alpha, lmda, eta, initial_temperature=MAX_TEMPERATURE, final_temperature=MIN_ANNEALING_TEMPERATURE, n_chains=1, seed=None):
+    '''
+    Fast search for the highest posterior list. Runs n_chains chains while their temperature is lowered
+    geometrically from initial_temperature to final_temperature over num_iterations.
+
+    Returns the highest posterior list any chain visited and its log posterior
+    '''
+    posterior = PosteriorModel.for_data(x, y, all_antecedents, alpha, lmda, eta)
+    chains = [Chain(posterior, all_antecedents, lmda, eta, chain_seed) for chain_seed in chain_seeds(n_chains, seed)]
+
+    best_state = max((chain.state for chain in chains), key=lambda state: state.log_posterior)
+    for i in range(num_iterations):
+        temperature = initial_temperature * (final_temperature / initial_temperature) ** (i / max(num_iterations - 1, 1))
+        for chain in chains:
+            chain.inverse_temperature = 1.0 / temperature
+            state = chain.step()
+            if state.log_posterior > best_state.log_posterior:
+                best_state = state
+
+    return best_state.d, best_state.log_posterior
@@ -1,22 +1,112 @@
-from collections import defaultdict
+from array import array
+from collections import defaultdict, OrderedDict
+import hashlib
 import random
 import math
+import weakref
+import numpy as np
+
+# Number of set bits in every possible byte, used to popcount packed bitsets
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+def pack_rows(mask):
+    '''
+    Pack a boolean mask over the samples into a uint8 bitset (8 samples per byte)
+    '''
+    return np.packbits(np.asarray(mask, dtype=bool))
+
+def unpack_rows(bitset, num_samples):
+    return np.unpackbits(bitset)[:num_samples].astype(bool)
+
+def popcount(bitset):
+    return int(POPCOUNT_TABLE[bitset].sum())
+
+def full_bitset(num_samples):
+    return pack_rows(np.ones(num_samples, dtype=bool))
+
+# Code given to (column, value) pairs missing from an ItemDictionary
+MISSING_ITEM = -1
+
+class ItemDictionary(object):
+    '''
+    Maps each (column, value) pair of the raw data to a dense int32 item code, so the model
+    works on integer matrices and raw values are only needed again for reporting
+    '''
+    def __init__(self):
+        self.codes = {} # (column, value) -> code
+        self.items = [] # code -> (column, value)
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, column, value):
+        code = self.codes.get((column, value))
+        if code is None:
+            code = len(self.items)
+            self.codes[(column, value)] = code
+            self.items.append((column, value))
+        return code
+
+    def encode(self, data_matrix, extend=False):
+        '''
+        Int32 matrix of item codes for data_matrix, values not in the dictionary are added if
+        extend is True and coded as MISSING_ITEM otherwise
+        '''
+        data_matrix = np.asarray(data_matrix, dtype=object)
+        encoded = np.empty(data_matrix.shape, dtype=np.int32)
+
+        for column in range(data_matrix.shape[1]):
+            column_codes = {}
+            # New values get codes in order of first appearance, so codes do not depend on string hashing
+            for value in dict.fromkeys(data_matrix[:, column]):
+                if extend:
+                    column_codes[value] = self.add(column, value)
+                else:
+                    column_codes[value] = self.codes.get((column, value), MISSING_ITEM)
+            encoded[:, column] = [column_codes[value] for value in data_matrix[:, column]]
+        return encoded
+
+    def decode(self, code):
+        return self.items[code]
+
+    def column(self, code):
+        return self.items[code][0]
+
+    def value(self, code):
+        return self.items[code][1]
 
 class Expression(object):
-    def __init__(self, index, op, value):
+    def __init__(self, index, op, value, item_dictionary=None):
         self.index = index
         self.op = op
         self.value = value
+        self.item_dictionary = item_dictionary # Decodes value when it is an item code
 
     def evaluate(self, x):
         return self.op(x[self.index], self.value)
 
+    def display_value(self):
+        if self.item_dictionary is not None:
+            return self.item_dictionary.value(self.value)
+        return self.value
+
     def __eq__(self, other_exp):
         return self.index == other_exp.index and self.value == other_exp.value and self.op == other_exp.op
 
 class Antecedent(object):
     def __init__(self, expressions):
         self.expressions = expressions
+        self.id = None # Position in the AntecedentGroup, set by the group
+
+    def evaluate_rows(self, data_matrix):
+        '''
+        Boolean mask of the rows of data_matrix that satisfy every expression
+        '''
+        data_matrix = np.asarray(data_matrix)
+        mask = np.ones(len(data_matrix), dtype=bool)
+        for exp in self.expressions:
+            mask &= exp.op(data_matrix[:, exp.index], exp.value)
+        return mask
 
     def evaluate(self, x):
         return all(exp.evaluate(x) for exp in self.expressions)
@@ -37,7 +127,7 @@ class Antecedent(object):
     def print_antecedent(self):
         exp_string = ""
         for exp in self.expressions:
-            exp_string += str(exp.value)
+            exp_string += str(exp.display_value())
             exp_string +=", "
         return exp_string
             
@@ -55,12 +145,53 @@ class AntecedentList(object):
     def get_antecedent_by_index(self, idx):
         return self.antecedents[idx]
 
+    def get_ids(self):
+        return tuple(ant.id for ant in self.antecedents)
+
     def get_first_antecedent_index(self, x):
         for i in range(len(self.antecedents)):
             if self.antecedents[i].evaluate(x):
                 return i
         return self.length()
 
+    def get_first_antecedent_indices(self, coverage):
+        '''
+        Vectorized get_first_antecedent_index over every row of the coverage index
+
+        coverage - CoverageIndex over the rows to classify, antecedents must have ids from its AntecedentGroup
+        '''
+        first_indices = np.full(coverage.num_samples, self.length(), dtype=np.intp)
+        remaining = full_bitset(coverage.num_samples)
+
+        for i, captured in enumerate(self.get_captures(coverage, remaining)):
+            first_indices[unpack_rows(captured, coverage.num_samples)] = i
+        return first_indices
+
+    def get_captures(self, coverage, remaining=None):
+        '''
+        Packed bitset of the rows captured by each antecedent in the list, i.e. the rows it
+        applies to that no earlier antecedent applies to. Rows left in remaining afterwards
+        fall through to the default rule.
+        '''
+        if remaining is None:
+            remaining = full_bitset(coverage.num_samples)
+
+        captures = []
+        for ant in self.antecedents:
+            bits = coverage.get_bitset(ant.id)
+            captures.append(bits & remaining)
+            remaining &= ~bits
+        return captures
+
+    def get_capture_counts(self, coverage):
+        '''
+        Number of rows captured by each antecedent, followed by the number falling through to the default rule
+        '''
+        remaining = full_bitset(coverage.num_samples)
+        counts = [popcount(captured) for captured in self.get_captures(coverage, remaining)]
+        counts.append(popcount(remaining))
+        return counts
+
     def contains(self, antecedent):
         return any(antecedent == current_ant for current_ant in self.antecedents)
 
@@ -91,11 +222,89 @@ class AntecedentList(object):
         # Return a 0 if none of the antecedents in the list apply to the sample
         return 0
 
+    def get_first_applying_antecedents(self, coverage):
+        '''
+        Vectorized get_first_applying_antecedent, 1-indexed with 0 for rows no antecedent applies to
+        '''
+        first_indices = self.get_first_antecedent_indices(coverage) + 1
+        first_indices[first_indices == self.length() + 1] = 0
+        return first_indices
+
+class RuleList(AntecedentList):
+    '''
+    Immutable AntecedentList stored as a tuple of antecedent ids into its AntecedentGroup plus a
+    frozenset of them for O(1) membership. Proposals build new RuleLists that share the group's
+    antecedents instead of deep copying the list.
+    '''
+    def __init__(self, group, ids, id_set=None):
+        self.group = group
+        self.ids = tuple(ids)
+        self.id_set = frozenset(self.ids) if id_set is None else id_set
+        self._antecedents = None
+
+    @property
+    def antecedents(self):
+        if self._antecedents is None:
+            self._antecedents = tuple(self.group.antecedents[i] for i in self.ids)
+        return self._antecedents
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_antecedents"] = None
+        return state
+
+    def length(self):
+        return len(self.ids)
+
+    def get_antecedent_by_index(self, idx):
+        return self.group.antecedents[self.ids[idx]]
+
+    def get_ids(self):
+        return self.ids
+
+    def contains(self, antecedent):
+        return self.contains_id(antecedent.id)
+
+    def contains_id(self, antecedent_id):
+        return antecedent_id in self.id_set
+
+    def moved(self, i, j):
+        '''
+        New RuleList with the antecedent at i moved to position j
+        '''
+        ids = list(self.ids)
+        ids.insert(j, ids.pop(i))
+        return RuleList(self.group, ids, self.id_set)
+
+    def removed(self, i):
+        '''
+        New RuleList without the antecedent at i
+        '''
+        return RuleList(self.group, self.ids[:i] + self.ids[i + 1:], self.id_set - {self.ids[i]})
+
+    def added(self, i, antecedent_id):
+        '''
+        New RuleList with the antecedent antecedent_id inserted at position i
+        '''
+        return RuleList(self.group, self.ids[:i] + (antecedent_id,) + self.ids[i:], self.id_set | {antecedent_id})
+
+    def move_antecedents(self, i, j):
+        raise TypeError("RuleList is immutable, use moved")
+
+    def remove_antecedent(self, i):
+        raise TypeError("RuleList is immutable, use removed")
+
+    def add_antecedent(self, i, antecedent):
+        raise TypeError("RuleList is immutable, use added")
+
 class AntecedentGroup(object):
-    def __init__(self, antecedents):
+    def __init__(self, antecedents, coverage=None, item_dictionary=None):
         self.antecedents_by_size = defaultdict(list)
         self.antecedents = antecedents
-        for antecedent in antecedents:
+        self.coverage = coverage # CoverageIndex over the training rows, None if not built
+        self.item_dictionary = item_dictionary # ItemDictionary the antecedents' values are coded with
+        for i, antecedent in enumerate(antecedents):
+            antecedent.id = i
             self.antecedents_by_size[antecedent.length()].append(antecedent)
 
     def sizes(self):
@@ -107,10 +316,212 @@ class AntecedentGroup(object):
     def length(self):
         return sum(self.lengths_by_size().values())
 
-    def get_random_antecedent(self):
-        return self.antecedents[random.randint(0, len(self.antecedents) - 1)]
+    def antecedent_sizes(self):
+        return [antecedent.length() for antecedent in self.antecedents]
+
+    def get_random_antecedent(self, rng=random):
+        return self.antecedents[self.get_random_antecedent_id(rng)]
+
+    def get_random_antecedent_id(self, rng=random):
+        return rng.randint(0, len(self.antecedents) - 1)
 
     def get_antecedents_by_length(self, length):
         return self.antecedents_by_size[length]
 
+    def subset(self, ids):
+        '''
+        New AntecedentGroup of the antecedents with the given ids, in that order. The antecedents are
+        copied since the new group renumbers them, and the coverage index is restricted to match.
+        '''
+        antecedents = [Antecedent(self.antecedents[i].expressions) for i in ids]
+
+        coverage = None
+        if isinstance(self.coverage, LazyCoverageIndex):
+            coverage = LazyCoverageIndex(antecedents, self.coverage.data_matrix, self.coverage.max_cached)
+        elif self.coverage is not None:
+            coverage = CoverageIndex(self.coverage.bitsets[list(ids)], self.coverage.num_samples, self.coverage.data_key)
+
+        return AntecedentGroup(antecedents, coverage, self.item_dictionary)
+
+def swap_remove(ids, positions, antecedent_id):
+    '''
+    Remove antecedent_id from the dense array ids in O(1) by moving the last id into its place
+    '''
+    position = positions[antecedent_id]
+    last_id = ids.pop()
+    if last_id != antecedent_id:
+        ids[position] = last_id
+        positions[last_id] = position
+    positions[antecedent_id] = -1
+
+class AntecedentPool(object):
+    '''
+    Ids of the antecedents of an AntecedentGroup that are not in some list, supporting O(1) uniform sampling
+    among all of them or among those of one cardinality, and O(1) insertion and removal. The free ids are kept
+    in dense arrays, overall and per cardinality, along with every id's position in them so it can be
+    swap-removed.
+
+    excluded_ids - ids taken out of the pool to begin with, usually those of the current list
+    '''
+    def __init__(self, all_antecedents, excluded_ids=()):
+        self.sizes = array("i", all_antecedents.antecedent_sizes())
+        self.ids = array("i", range(len(self.sizes)))
+        self.positions = array("i", range(len(self.sizes)))
+        self.ids_by_size = {size: array("i") for size in all_antecedents.sizes()}
+        self.size_positions = array("i", bytes(self.positions.itemsize * len(self.sizes)))
+        for antecedent_id, size in enumerate(self.sizes):
+            self.size_positions[antecedent_id] = len(self.ids_by_size[size])
+            self.ids_by_size[size].append(antecedent_id)
+
+        for antecedent_id in excluded_ids:
+            self.remove(antecedent_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, antecedent_id):
+        return self.positions[antecedent_id] >= 0
+
+    def length_of_size(self, size):
+        return len(self.ids_by_size.get(size, ()))
+
+    def sample(self, rng=random):
+        return self.ids[rng.randrange(len(self.ids))]
+
+    def sample_of_size(self, size, rng=random):
+        ids = self.ids_by_size[size]
+        return ids[rng.randrange(len(ids))]
+
+    def remove(self, antecedent_id):
+        swap_remove(self.ids, self.positions, antecedent_id)
+        swap_remove(self.ids_by_size[self.sizes[antecedent_id]], self.size_positions, antecedent_id)
+
+    def add(self, antecedent_id):
+        self.positions[antecedent_id] = len(self.ids)
+        self.ids.append(antecedent_id)
+        ids = self.ids_by_size[self.sizes[antecedent_id]]
+        self.size_positions[antecedent_id] = len(ids)
+        ids.append(antecedent_id)
+
+    def update(self, current_d, new_d):
+        '''
+        Make the pool exclude the RuleList new_d instead of current_d, touching only the ids that differ
+        '''
+        if current_d is new_d:
+            return
+        for antecedent_id in current_d.id_set - new_d.id_set:
+            self.add(antecedent_id)
+        for antecedent_id in new_d.id_set - current_d.id_set:
+            self.remove(antecedent_id)
+
+def encode_rows(data_matrix, item_dictionary=None):
+    '''
+    data_matrix as item codes, rows of raw values are encoded with item_dictionary
+    '''
+    data_matrix = np.asarray(data_matrix)
+    if data_matrix.dtype.kind not in "iu" and item_dictionary is not None:
+        return item_dictionary.encode(data_matrix)
+    return data_matrix
+
+def data_key(data_matrix):
+    '''
+    Hex digest of the contents of a data matrix, integer matrices hash alike whatever their integer dtype
+    '''
+    data_matrix = np.asarray(data_matrix)
+    if data_matrix.dtype.kind in "iu":
+        data_matrix = data_matrix.astype(np.int64)
+    digest = hashlib.sha256(repr((data_matrix.shape, data_matrix.dtype.str)).encode())
+    if data_matrix.dtype.kind == "O":
+        digest.update(repr(data_matrix.tolist()).encode())
+    else:
+        digest.update(np.ascontiguousarray(data_matrix).tobytes())
+    return digest.hexdigest()
+
+class CoverageIndex(object):
+    '''
+    Packed bitset per antecedent over the training rows, bit i of row r is set if antecedent r
+    applies to sample i. Rows are indexed by Antecedent.id.
+
+    data_key - data_key of the rows the index was built over, None if they are unknown
+    '''
+    def __init__(self, bitsets, num_samples, data_key=None):
+        self.bitsets = bitsets
+        self.num_samples = num_samples
+        self.data_key = data_key
+        self.verified_data = None # weak reference to the last data matrix found to match data_key
+
+    @classmethod
+    def from_antecedents(cls, antecedents, data_matrix):
+        num_samples = len(data_matrix)
+        bitsets = np.zeros((len(antecedents), (num_samples + 7) // 8), dtype=np.uint8)
+        for i, ant in enumerate(antecedents):
+            bitsets[i] = pack_rows(ant.evaluate_rows(data_matrix))
+        return cls(bitsets, num_samples, data_key(data_matrix))
+
+    def built_over(self, data_matrix, item_dictionary=None):
+        '''
+        Whether the index was built over exactly the rows of data_matrix, in the same order. Raw rows are encoded
+        with item_dictionary before their contents are compared, and the last matching matrix is remembered so
+        passing it again skips the comparison. An index over unknown rows matches nothing.
+        '''
+        if self.data_key is None or len(data_matrix) != self.num_samples:
+            return False
+        if self.verified_data is not None and self.verified_data() is data_matrix:
+            return True
+        if data_key(encode_rows(data_matrix, item_dictionary)) != self.data_key:
+            return False
+        try:
+            self.verified_data = weakref.ref(data_matrix)
+        except TypeError:
+            pass # lists cannot be weakly referenced, they are compared every time
+        return True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["verified_data"] = None
+        return state
+
+    def get_bitset(self, antecedent_id):
+        return self.bitsets[antecedent_id]
+
+    def get_bitsets(self, antecedent_ids):
+        return self.bitsets[antecedent_ids]
+
+    def support(self, antecedent_id):
+        return popcount(self.get_bitset(antecedent_id))
+
+    def nbytes(self):
+        return self.bitsets.nbytes
+
+class LazyCoverageIndex(CoverageIndex):
+    '''
+    Bounded-memory CoverageIndex that evaluates bitsets on demand and keeps at most
+    max_cached of them behind an LRU. Holds a reference to the training data.
+    '''
+    def __init__(self, antecedents, data_matrix, max_cached):
+        self.antecedents = antecedents
+        self.data_matrix = np.asarray(data_matrix)
+        self.num_samples = len(data_matrix)
+        self.data_key = data_key(self.data_matrix)
+        self.verified_data = None
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+
+    def get_bitset(self, antecedent_id):
+        bitset = self.cache.get(antecedent_id)
+        if bitset is not None:
+            self.cache.move_to_end(antecedent_id)
+            return bitset
+
+        bitset = pack_rows(self.antecedents[antecedent_id].evaluate_rows(self.data_matrix))
+        self.cache[antecedent_id] = bitset
+        if len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+        return bitset
+
+    def get_bitsets(self, antecedent_ids):
+        return np.array([self.get_bitset(antecedent_id) for antecedent_id in antecedent_ids], dtype=np.uint8).reshape(len(antecedent_ids), (self.num_samples + 7) // 8)
+
+    def nbytes(self):
+        return sum(bitset.nbytes for bitset in self.cache.values())
 
@@ -0,0 +1,202 @@
+import math
+import random
+from collections import defaultdict
+
+from .utils import *
+from .generative_model import *
+
+# Ways brl_metropolis_hastings can start its chains, see initial_lists
+PRIOR_INIT = "prior"
+GREEDY_INIT = "greedy"
+BEAM_INIT = "beam"
+
+# Lists kept at every step of a BEAM_INIT search
+BEAM_WIDTH = 5
+
+# Temperature the searches draw the lists they keep at, on the log posterior scale. At 1 lists are kept in
+# proportion to their posterior, so the chains' starts differ, at 0 the search is deterministic.
+INIT_TEMPERATURE = 1.0
+
+# Lists scored per LikelihoodModel.score_batch call, which bounds the searches' memory whatever the number of antecedents
+NEIGHBOUR_BATCH_SIZE = 1024
+
+# Searches tried per chain for a start distinct from the other chains' before drawing it from the prior instead
+MAX_WARM_START_SEARCHES = 10
+
+def neighbour_log_priors(prior_cache, state, length_change):
+    '''
+    log prior of the lists length_change (1 or -1) antecedents longer than state's list, by the cardinality of
+    the antecedent added or removed. Computed like PosteriorModel does so the values match exactly.
+    '''
+    log_priors = {}
+    for size, R_c in prior_cache.lengths_by_size.items():
+        size_counts = defaultdict(int, state.size_counts)
+        size_counts[size] += length_change
+        if 0 <= size_counts[size] <= R_c:
+            log_priors[size] = prior_cache.log_prior_from_counts(len(state.ids) + length_change, size_counts)
+    return log_priors
+
+def score_neighbours(posterior, state, ids_batch, positions):
+    '''
+    log posterior of lists a single add, remove or move away from state, list k first differing from it at
+    positions[k]. Searches score thousands of lists per step, so only their ids are built, they are not memoized,
+    and they are scored NEIGHBOUR_BATCH_SIZE at a time.
+    '''
+    prior_cache = posterior.prior_cache
+    log_prior = prior_cache.log_prior_from_counts(len(state.ids), state.size_counts)
+    added_log_priors = neighbour_log_priors(prior_cache, state, 1)
+    removed_log_priors = neighbour_log_priors(prior_cache, state, -1)
+
+    log_likelihoods = []
+    for start in range(0, len(ids_batch), NEIGHBOUR_BATCH_SIZE):
+        log_likelihoods.extend(posterior.likelihood.score_batch(state.capture, ids_batch[start:start + NEIGHBOUR_BATCH_SIZE], positions[start:start + NEIGHBOUR_BATCH_SIZE]))
+
+    log_posteriors = []
+    for ids, position, log_likelihood in zip(ids_batch, positions, log_likelihoods):
+        if len(ids) > len(state.ids):
+            log_posteriors.append(added_log_priors[prior_cache.antecedent_sizes[ids[position]]] + log_likelihood)
+        elif len(ids) < len(state.ids):
+            log_posteriors.append(removed_log_priors[prior_cache.antecedent_sizes[state.ids[position]]] + log_likelihood)
+        else:
+            log_posteriors.append(log_prior + log_likelihood)
+    return log_posteriors
+
+def beam_search(posterior, all_antecedents, beam_width, rng=random, temperature=0.0, excluded_first_ids=()):
+    '''
+    Builds lists one antecedent at a time: every list kept is extended with each antecedent it does not hold
+    appended after its last rule, all of them scored in one batch, and the beam_width best extensions are kept.
+    Stops once no extension raises the log posterior of the list it extends.
+
+    temperature - above 0 the extensions kept are drawn without replacement in proportion to
+        exp(log posterior / temperature) instead, with the Gumbel top-k trick
+    excluded_first_ids - antecedents the lists may not start with
+
+    Returns the ChainState of the highest posterior list found, None if every antecedent is excluded
+    '''
+    excluded_first_ids = frozenset(excluded_first_ids)
+    beam = [posterior.create_chain_state(RuleList(all_antecedents, ()))]
+    best = None
+    while beam:
+        candidates = []
+        for state in beam:
+            # The empty list only seeds the search, its extensions are kept whether they improve on it or not
+            excluded_ids = state.d.id_set if state.ids else excluded_first_ids
+            extensions = [state.ids + (antecedent_id,) for antecedent_id in range(all_antecedents.length()) if antecedent_id not in excluded_ids]
+            if not extensions:
+                continue
+            for ids, log_posterior in zip(extensions, score_neighbours(posterior, state, extensions, [len(state.ids)] * len(extensions))):
+                if not state.ids or log_posterior > state.log_posterior:
+                    candidates.append((log_posterior, ids, state))
+
+        if temperature > 0:
+            keys = [log_posterior / temperature - math.log(rng.expovariate(1.0)) for log_posterior, ids, state in candidates]
+        else:
+            keys = [log_posterior for log_posterior, ids, state in candidates]
+        kept = sorted(range(len(candidates)), key=lambda k: keys[k], reverse=True)[:beam_width]
+
+        beam = []
+        for k in kept:
+            log_posterior, ids, state = candidates[k]
+            beam.append(posterior.accept(posterior.propose(state, RuleList(all_antecedents, ids))))
+        for state in beam:
+            if best is None or state.log_posterior > best.log_posterior:
+                best = state
+    return best
+
+def neighbours(ids, num_antecedents):
+    '''
+    (ids, first changed position) of every list a single move, remove or add proposal can reach from ids
+    '''
+    lists = []
+    id_set = set(ids)
+    for i in range(len(ids)):
+        if len(ids) > 1:
+            lists.append((ids[:i] + ids[i + 1:], i))
+        for j in range(len(ids)):
+            if j != i:
+                moved = list(ids)
+                moved.insert(j, moved.pop(i))
+                lists.append((tuple(moved), min(i, j)))
+    for antecedent_id in range(num_antecedents):
+        if antecedent_id not in id_set:
+            lists.extend((ids[:i] + (antecedent_id,) + ids[i:], i) for i in range(len(ids) + 1))
+    return lists
+
+def hill_climb(posterior, state, all_antecedents, excluded_first_ids=()):
+    '''
+    Moves from state to its highest posterior neighbour until none improves on it. Reaches lists the search's
+    appending cannot, e.g. ones needing a rule inserted ahead of the others.
+
+    excluded_first_ids - antecedents the lists climbed to may not start with
+    '''
+    while True:
+        lists = [(ids, position) for ids, position in neighbours(state.ids, all_antecedents.length()) if ids[0] not in excluded_first_ids]
+        if not lists:
+            return state
+        log_posteriors = score_neighbours(posterior, state, [ids for ids, position in lists], [position for ids, position in lists])
+        best = max(range(len(lists)), key=log_posteriors.__getitem__)
+        if log_posteriors[best] <= state.log_posterior:
+            return state
+        state = posterior.accept(posterior.propose(state, RuleList(all_antecedents, lists[best][0])))
+
+def warm_start_lists(posterior, all_antecedents, n_chains, rng=random, beam_width=BEAM_WIDTH, temperature=INIT_TEMPERATURE, diversify=True):
+    '''
+    Starting lists of n_chains chains found with beam_search and refined with hill_climb, near the posterior's
+    modes so little burn in is needed. Starting every chain on the same mode would make the split R-hat pass
+    before the chains explored anything, so the searches draw their lists at temperature and, with diversify,
+    every chain's start must differ from the starts of the chains before it in its first antecedent, its set
+    of antecedents and its log posterior, which keeps the starts on different modes. A climbed list that is
+    not distinct falls back to the search's own list, and if neither is, the search is repeated with its first
+    antecedent excluded too. After MAX_WARM_START_SEARCHES searches the start is drawn from the prior.
+    '''
+    starts = []
+    for j in range(n_chains):
+        excluded_first_ids = set(state.ids[0] for state in starts) if diversify else set()
+        start = None
+        for search in range(MAX_WARM_START_SEARCHES):
+            state = beam_search(posterior, all_antecedents, beam_width, rng, temperature, excluded_first_ids)
+            if state is None:
+                break
+            climbed = hill_climb(posterior, state, all_antecedents, excluded_first_ids)
+            start = next((candidate for candidate in (climbed, state) if not diversify or distinct_start(candidate, starts)), None)
+            if start is not None:
+                break
+            excluded_first_ids.add(state.ids[0])
+
+        if start is None:
+            start = posterior.create_chain_state(generate_default_antecedent_list(all_antecedents, posterior.prior_cache.lmda, posterior.prior_cache.eta, posterior.prior_cache, rng))
+        print("Warm Start Log Posterior:", start.log_posterior, "Length:", len(start.ids))
+        starts.append(start)
+    return [state.d for state in starts]
+
+def distinct_start(state, starts):
+    '''
+    Whether state differs from every state of starts in its first antecedent, its set of antecedents and its
+    log posterior. Lists holding the same rules in another order often capture the same rows, so both sets and
+    log posteriors are compared, not just the lists.
+    '''
+    for start in starts:
+        if state.ids[0] == start.ids[0] or state.d.id_set == start.d.id_set or math.isclose(state.log_posterior, start.log_posterior, rel_tol=0.0, abs_tol=1e-9):
+            return False
+    return True
+
+def initial_lists(init, posterior, all_antecedents, n_chains, seed):
+    '''
+    Starting list of every chain for a sampler's init argument: PRIOR_INIT draws them from the prior as
+    each chain starts, so gives None, GREEDY_INIT and BEAM_INIT search for them with warm_start_lists, with
+    a beam of 1 and BEAM_WIDTH lists respectively. A sequence of n_chains RuleLists or antecedent id
+    sequences is used as is.
+
+    seed - seed of the searches' random stream
+    '''
+    if isinstance(init, str):
+        if init == PRIOR_INIT:
+            return None
+        if init not in (GREEDY_INIT, BEAM_INIT):
+            raise ValueError("Unknown init {}, expected {}, {}, {} or a list per chain".format(init, PRIOR_INIT, GREEDY_INIT, BEAM_INIT))
+        beam_width = 1 if init == GREEDY_INIT else BEAM_WIDTH
+        return warm_start_lists(posterior, all_antecedents, n_chains, random.Random(seed), beam_width)
+
+    if len(init) != n_chains:
+        raise ValueError("init has {} lists for {} chains".format(len(init), n_chains))
+    return [d if isinstance(d, RuleList) else RuleList(all_antecedents, d) for d in init]
@@ -173,6 +173,10 @@ def find_brl(train_on_all_data):
 	data = data.drop('disease_status', 1) # Remove true predictive value from training data
 	data_matrix_all = data.as_matrix()
 
+	# Encode each (column, value) pair as an integer item code, the model only decodes them for printing
+	item_dictionary = ItemDictionary()
+	data_matrix_all = item_dictionary.encode(data_matrix_all, extend=True)
+
 	# *** Heart Disease-Specific Data Processing End***
 
 	# No K-Fold
@@ -308,7 +312,7 @@ def find_brl(train_on_all_data):
 		confidence_interval_width = 0.95
 
 		# Frequent-Pattern (FP) Growth Algorithm: (brl.antecedent_mining)
-		all_antecedents = generate_antecedent_list(data_matrix, num_samples, min_support_threshold, max_antecedent_length)
+		all_antecedents = generate_antecedent_list(data_matrix, num_samples, min_support_threshold, max_antecedent_length, item_dictionary=item_dictionary)
 
 		print("Number of Antecdents Mined: {}".format(len(all_antecedents.antecedents)))
 		# MCMC - Metropolis Hastings
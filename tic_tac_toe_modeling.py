@@ -105,6 +105,10 @@ def find_brl():
     data = data.drop('result', 1) # Remove true predictive value from training data
     data_matrix = data.as_matrix()
 
+    # Encode each (column, value) pair as an integer item code, the model only decodes them for printing
+    item_dictionary = ItemDictionary()
+    data_matrix = item_dictionary.encode(data_matrix, extend=True)
+
     num_samples = len(data_matrix)
 
     # FP-Growth Parameters
@@ -129,7 +133,7 @@ def find_brl():
     confidence_interval_width = 0.95
 
     # Frequent-Pattern (FP) Growth Algorithm: (brl.antecedent_mining)
-    all_antecedents = generate_antecedent_list(data_matrix, num_samples, min_support_threshold, max_antecedent_length)
+    all_antecedents = generate_antecedent_list(data_matrix, num_samples, min_support_threshold, max_antecedent_length, item_dictionary=item_dictionary)
 
     print("Number of Antecdents Mined: {}".format(len(all_antecedents.antecedents)))
     # MCMC - Metropolis Hastings
@@ -45,6 +45,10 @@ def find_brl(train_with_all):
 
     data_matrix_all = data_only_complete.as_matrix()
 
+    # Encode each (column, value) pair as an integer item code, the model only decodes them for printing
+    item_dictionary = ItemDictionary()
+    data_matrix_all = item_dictionary.encode(data_matrix_all, extend=True)
+
     data_matrix = None
     outcomes = None
     data_test = None
@@ -82,7 +86,7 @@ def find_brl(train_with_all):
     confidence_interval_width = 0.95
 
     # Frequent-Pattern (FP) Growth Algorithm: (brl.antecedent_mining)
-    all_antecedents = generate_antecedent_list(data_matrix, num_samples, min_support_threshold, max_antecedent_length)
+    all_antecedents = generate_antecedent_list(data_matrix, num_samples, min_support_threshold, max_antecedent_length, item_dictionary=item_dictionary)
 
     print("Number of Antecdents Mined: {}".format(len(all_antecedents.antecedents)))
     # MCMC - Metropolis Hastings
@@ -116,10 +120,10 @@ def find_brl(train_with_all):
     # Evaluate the BRL on the test set
     make_brl_test_set_predictions(data_test, outcome_test, N_posterior, brl_point_list, alpha, 0.5)
     find_auc(data_test, outcome_test, N_posterior, brl_point_list, alpha)
-    return N_posterior, brl_point_list
+    return N_posterior, brl_point_list, item_dictionary
 
 # Generate file for kaggle upload
-def generate_titanic_kaggle_prediction(N_posterior, brl_point_list, alpha):
+def generate_titanic_kaggle_prediction(N_posterior, brl_point_list, alpha, item_dictionary):
 
     output_file = open("titanic_test_set_results.txt", 'w')
     output_file.write("PassengerId,Survived\n")
@@ -134,10 +138,11 @@ def generate_titanic_kaggle_prediction(N_posterior, brl_point_list, alpha):
     test_data['Sex'] = test_data['Sex'].apply(lambda x: str.title(x))
 
     test_data_matrix = test_data.as_matrix()
+    test_features = item_dictionary.encode(test_data_matrix[:, 1:])
 
     for i, features in enumerate(test_data_matrix):
         passenger_id = features[0]
-        feats = features[1:]
+        feats = test_features[i]
         prediction = brl_point_predict(feats, N_posterior, brl_point_list, alpha)
 
         output_file.write(str(passenger_id))
@@ -152,6 +157,6 @@ def generate_titanic_kaggle_prediction(N_posterior, brl_point_list, alpha):
 if __name__=='__main__':
     
     train_with_all = False
-    N_posterior, brl_point_list = find_brl(train_with_all)
+    N_posterior, brl_point_list, item_dictionary = find_brl(train_with_all)
     alpha = [1,1]
-    generate_titanic_kaggle_prediction(N_posterior, brl_point_list, alpha)
+    generate_titanic_kaggle_prediction(N_posterior, brl_point_list, alpha, item_dictionary)